@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import pathlib
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import cv2
+import numpy as np
+import config as cf
+
+SYNTHETIC_VIDEOS = ((150, (640, 480)), (600, (640, 480)), (300, (1280, 720)))
+QUICK_VIDEOS = ((60, (640, 480)),)
+
+
+def get_tube_maps(size_, texture_size_) -> tuple:
+    # every pixel of the frame looks at a point of the tube wall, further away closer to the centre
+    width, height = size_
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    x -= width / 2
+    y -= height / 2
+    radius = np.maximum(np.sqrt(x * x + y * y), 1)
+    angle = (np.arctan2(y, x) + np.pi) / (2 * np.pi) * (texture_size_[0] - 1)
+    depth = height * 40 / radius
+    return angle, depth
+
+
+def make_synthetic_video(path_, frames_: int, size_, fps_: float = 30.) -> None:
+    rng = np.random.default_rng(frames_ * 7919 + size_[0])
+    texture_size = (1024, 4096)
+    texture = cv2.GaussianBlur(rng.integers(40, 200, (texture_size[1], texture_size[0], 3), dtype=np.uint8), (0, 0), 3)
+    # bright spots play the dust
+    for x, y in rng.integers(0, texture_size[0] - 20, (300, 2)):
+        cv2.circle(texture, (int(x), int(y * texture_size[1] // texture_size[0])), int(rng.integers(3, 9)),
+                   (250, 250, 250), -1)
+    angle, depth = get_tube_maps(size_, texture_size)
+    writer = cv2.VideoWriter(str(path_), cv2.VideoWriter_fourcc(*'mp4v'), fps_, size_)
+    if not writer.isOpened():
+        raise IOError(f"Can't write {path_}")
+    try:
+        for i in range(frames_):
+            # the camera moves 6 texture rows down the tube every frame
+            map_y = (depth + 6 * i) % (texture_size[1] - 1)
+            frame = cv2.remap(texture, angle, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+
+def get_synthetic_videos(videos_) -> list:
+    root = pathlib.Path(cf.BENCH_DATA_PATH)
+    root.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for frames, size in videos_:
+        path = root / f'synthetic {frames}f {size[0]}x{size[1]}.mp4'
+        if not path.exists():
+            print(f'Generating {path.name}')
+            make_synthetic_video(path, frames, size)
+        paths.append(path)
+    return paths
+
+
+def measure(func_, repeat_: int) -> tuple:
+    # the best of the timed runs, then one more run for the peak memory of python and numpy allocations
+    seconds = float('inf')
+    for _ in range(repeat_):
+        start_time = time.perf_counter()
+        result = func_()
+        seconds = min(seconds, time.perf_counter() - start_time)
+    tracemalloc.start()
+    func_()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_mib': peak / 2 ** 20}
+
+
+def get_qapplication():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+def bench_video(video_path, args) -> dict:
+    from video_logic import read_video, get_slice, get_source_slice, get_map, rotate_map, skew_map, crop_img, \
+        get_counters_list, dust_selection
+    from export_logic import export_map
+    from window_logic import PaintTube
+
+    video_path = str(video_path)
+    results = {}
+
+    def run_stage(name_, func_, items_=None):
+        result, stats = measure(func_, args.repeat)
+        if items_ is not None:
+            stats['items'] = items_(result)
+            stats['items_per_s'] = stats['items'] / max(stats['seconds'], 1e-9)
+        results[name_] = stats
+        print(f'  {name_.ljust(20)} {stats["seconds"]:9.4f} s {stats["peak_mib"]:9.1f} MiB',
+              f'{stats["items_per_s"]:10.1f} /s' if items_ is not None else '')
+        return result
+
+    run_stage('read_video', lambda: sum(1 for _ in read_video(video_path, cf.IMG_SIZE, frames_freq=args.frame_freq)),
+              lambda count: count)
+    frames = [frame for _, frame in zip(range(50), read_video(video_path, cf.IMG_SIZE, frames_freq=1))]
+    run_stage('get_slice', lambda: [get_slice(frame, args.thickness) for frame in frames], len)
+    frames = [frame for _, frame in zip(range(50), read_video(video_path, None, frames_freq=1))]
+    run_stage('get_source_slice', lambda: [get_source_slice(frame, args.thickness) for frame in frames], len)
+    img = run_stage('get_map', lambda: get_map(video_path, args.thickness, args.frame_freq),
+                    lambda result: result.shape[0] // args.thickness)
+    run_stage('rotate_map', lambda: rotate_map(img, args.thickness), lambda result: result[0].shape[0])
+    skewed = run_stage('skew_map', lambda: skew_map(img, args.skew))
+    run_stage('crop_img', lambda: crop_img(skewed, is_copy_=True))
+    contours = run_stage('get_counters_list', lambda: get_counters_list(skewed, args.dust_thresh, args.dust_min_area),
+                         len)
+    run_stage('dust_selection', lambda: dust_selection(skewed, args.dust_thresh, args.dust_min_area))
+    get_qapplication()
+    # a new overlay is built from the background, a reused one only redraws the pixels of the contours
+    run_stage('connect_img', lambda: PaintTube().connect_img(skewed, contours))
+    paint_tube = PaintTube()
+    paint_tube.connect_img(skewed, contours)
+    run_stage('connect_img_update', lambda: paint_tube.connect_img(skewed, contours))
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        def end_to_end():
+            result = skew_map(rotate_map(get_map(video_path, args.thickness, args.frame_freq), args.thickness)[0], args.skew)
+            result = dust_selection(result, args.dust_thresh, args.dust_min_area)
+            return export_map(result, os.path.join(out_dir, 'map.png'))
+        run_stage('end_to_end', end_to_end)
+    return results
+
+
+def compare(results_: dict, baseline_: dict, threshold_: float) -> list:
+    slower = []
+    print('\nVideo / stage'.ljust(57), 'Base, s'.rjust(9), 'Now, s'.rjust(9), 'Ratio'.rjust(7))
+    for video, stages in results_.items():
+        for stage, stats in stages.items():
+            base = baseline_.get(video, {}).get(stage)
+            if base is None:
+                continue
+            ratio = stats['seconds'] / max(base['seconds'], 1e-9)
+            # timings under the noise floor are shown but never fail the run
+            is_slower = ratio > 1 + threshold_ and base['seconds'] >= cf.BENCH_MIN_SECONDS
+            print(f'{video} / {stage}'.ljust(56), f'{base["seconds"]:9.4f}', f'{stats["seconds"]:9.4f}',
+                  f'{ratio:7.2f}', '<- slower' if is_slower else '')
+            if is_slower:
+                slower.append((video, stage, ratio))
+    return slower
+
+
+def benchmark(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Timings and peak memory of every TubeMapping pipeline stage.')
+    parser.add_argument('--output', default=cf.BENCH_DATA_PATH + '/results.json', help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=cf.BENCH_THRESHOLD,
+                        help='allowed slowdown against the baseline, 0.2 is 20%%')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='one short synthetic video')
+    parser.add_argument('--no-real', action='store_true', help=f'skip the clips in {cf.INPUT_DATA_PATH}/')
+    parser.add_argument('--thickness', type=int, default=cf.DEFAULT_THICKNESS)
+    parser.add_argument('--frame-freq', type=int, default=cf.DEFAULT_FRAME_FREQUENCY)
+    parser.add_argument('--skew', type=int, default=cf.DEFAULT_SKEW_EFFECT)
+    parser.add_argument('--dust-thresh', type=int, default=cf.DEFAULT_DUST_THRESH)
+    parser.add_argument('--dust-min-area', type=int, default=cf.DEFAULT_DUST_MIN_AREA)
+    args = parser.parse_args(argv)
+
+    videos = get_synthetic_videos(QUICK_VIDEOS if args.quick else SYNTHETIC_VIDEOS)
+    if not args.no_real and not args.quick:
+        videos += sorted(pathlib.Path(cf.INPUT_DATA_PATH).glob('*.mp4'))
+
+    results = {}
+    for video_path in videos:
+        print(video_path.name)
+        results[video_path.name] = bench_video(video_path, args)
+
+    report = {
+        'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'opencv': cv2.__version__, 'platform': platform.platform(),
+                 'cpu_count': os.cpu_count(), 'repeat': args.repeat,
+                 'params': {'thickness': args.thickness, 'frame_freq': args.frame_freq, 'skew': args.skew,
+                            'dust_thresh': args.dust_thresh, 'dust_min_area': args.dust_min_area}},
+        'results': results,
+    }
+    pathlib.Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    print(f'\nResults saved to {args.output}')
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline, encoding='utf-8') as file:
+        baseline = json.load(file)
+    slower = compare(results, baseline['results'], args.threshold)
+    if len(slower) > 0:
+        print(f'\n{len(slower)} stage(s) slower than the baseline by more than {args.threshold:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark())
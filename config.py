@@ -10,8 +10,99 @@ IMG_SIZE = (640, 480)
 DEFAULT_FRAME_FREQUENCY = 1
 DEFAULT_THICKNESS = 4
 DEFAULT_SKEW_EFFECT = 15
+DEFAULT_SAMPLE_MS = 0
+DEFAULT_DUST_THRESH = 200
+DEFAULT_DUST_MIN_AREA = 50
+
+SEEK_MIN_STRIDE = 50
+# keyframe seeking may land a frame early on some containers
+SEEK_BY_FRAMES = False
+
+DEFAULT_DECODE_WORKERS = 1
+CHUNK_MIN_FRAMES = 200
+CHUNKS_PER_WORKER = 2
+CHUNK_SEEK_MARGIN = 8
+CHUNK_POLL_INTERVAL = 0.1
+# a single process map is decoded, cut into strips and assembled on separate threads, 0 threads runs them in turn
+PIPELINE_THREADS = 2
+PIPELINE_DEPTH = 8
+PIPELINE_POLL_INTERVAL = 0.1
+
+# frames are compared at this size, the smoothed camera path follows a tenth of every move
+STAB_SIZE = (160, 120)
+STAB_SMOOTHING = 0.1
+STAB_ANGLE_BINS = 360
+STAB_RADIUS_BINS = 64
+STAB_MIN_RESPONSE = 0.05
+# shake moves the frame by less than this between two samples
+STAB_MAX_SHIFT = 0.1
+STAB_MAX_ANGLE = 5.
+# part of the map store key of stabilized maps, bumped whenever the stabilized output changes
+STAB_VERSION = 2
+
+# adaptive sampling takes a strip once the wall moved by its thickness times MOTION_TRAVEL
+MOTION_TRAVEL = 1.
+# the map of an adaptive run is first sized as for every N-th frame and grows if needed
+ADAPTIVE_MIN_FREQUENCY = 4
+MOTION_SIZE = (160, 120)
+# the flow is measured over the outer half of the frame radius
+MOTION_RING = 0.5
+
+# the roll of the probe is measured between the strips of two frames, weaker correlations are noise
+ROTATE_MIN_RESPONSE = 0.5
+ROTATE_HIGHPASS = 8
+# the seam moves by less than this part of the width between two blocks
+ROTATE_MAX_SHIFT = 0.1
+
+DUST_TILE_ROWS = 2048
+DUST_WORKERS = 4
+
+PROGRESS_MIN_FRAMES = 10
+PROGRESS_INTERVAL = 0.25
+PREVIEW_REDRAW_INTERVAL = 500
+# before a new map is built a quick one is shown, made of about PREVIEW_STRIPS frames at PREVIEW_SCALE of IMG_SIZE
+QUICK_PREVIEW = True
+PREVIEW_STRIPS = 300
+PREVIEW_SCALE = 0.25
+
+JOB_WORKERS = 1
+
+STAGE_CACHE_MAX_BYTES = 1 << 30
+
+MAP_STORE_PATH = OUT_DATA_PATH + '/store'
+MAP_STORE_MAX_BYTES = 8 << 30
+
+# out of core runs keep the maps in files and go through them by blocks of rows
+OUT_OF_CORE = False
+SCRATCH_PATH = OUT_DATA_PATH + '/scratch'
+BLOCK_ROWS = 8192
+
+EXPORT_PNG_COMPRESSION = 3
+EXPORT_JPEG_QUALITY = 95
+EXPORT_MAX_ROWS = 32000
+
+STATS_ENABLED = True
+STATS_TRACE_MEMORY = True
+STATS_LOG_PATH = OUT_DATA_PATH + '/stats.jsonl'
+PROFILE_PATH = OUT_DATA_PATH + '/profile'
+
+BENCH_DATA_PATH = OUT_DATA_PATH + '/bench'
+BENCH_THRESHOLD = 0.2
+BENCH_MIN_SECONDS = 0.005
 
 MAIN_WINDOW_TITLE = 'TubeMapping'
 MAIN_WINDOW_MINIMUM_SIZE = QSize(800, 800)
 
 DEFAULT_MAP_SIZE = QSize(600, 1400)
+
+VIEWER_TILE_SIZE = 512
+VIEWER_MIN_LEVEL_SIZE = 64
+VIEWER_MIN_ZOOM = 0.05
+VIEWER_MAX_ZOOM = 8.
+VIEWER_ZOOM_STEP = 1.25
+VIEWER_SCROLL_STEP = 40
+VIEWER_OVERLAY_COLOR = (0, 0, 255)
+
+TUBE_BACKGROUND_COLOR = (250, 250, 250, 255)
+
+STARTUP_BUDGET_MS = 500
@@ -0,0 +1,241 @@
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import config as cf
+from scratch_store import scratch_store
+
+
+class DustTable:
+    def __init__(self, stats_, centroids_, brightness_, mask_, offset_=(0, 0)):
+        # one row per defect, mask_ holds the pixels of the defects
+        self.left = stats_[:, cv2.CC_STAT_LEFT] + offset_[0]
+        self.top = stats_[:, cv2.CC_STAT_TOP] + offset_[1]
+        self.width = stats_[:, cv2.CC_STAT_WIDTH]
+        self.height = stats_[:, cv2.CC_STAT_HEIGHT]
+        self.area = stats_[:, cv2.CC_STAT_AREA]
+        self.cx = centroids_[:, 0] + offset_[0]
+        self.cy = centroids_[:, 1] + offset_[1]
+        self.brightness = brightness_
+        self.mask = mask_
+        self.offset = offset_
+        self.contours = None
+
+    def __len__(self) -> int:
+        return len(self.area)
+
+    @property
+    def nbytes(self) -> int:
+        mask_nbytes = 0 if isinstance(self.mask, np.memmap) else self.mask.nbytes
+        return mask_nbytes + sum(column.nbytes for column in self.get_columns().values())
+
+    def get_columns(self) -> dict:
+        return {'area': self.area, 'left': self.left, 'top': self.top, 'width': self.width, 'height': self.height,
+                'cx': self.cx, 'cy': self.cy, 'brightness': self.brightness}
+
+    def get_bands(self) -> list:
+        # runs of mask rows covered by defects, no defect crosses the border of two of them
+        order = np.argsort(self.top, kind='stable')
+        tops = self.top[order] - self.offset[1]
+        bottoms = np.maximum.accumulate((self.top + self.height)[order] - self.offset[1])
+        breaks = np.flatnonzero(tops[1:] >= bottoms[:-1])
+        return list(zip(tops[np.r_[0, breaks + 1]].tolist(), bottoms[np.r_[breaks, len(tops) - 1]].tolist()))
+
+    def get_contours(self) -> list:
+        # contours are only needed for display, they are traced once on first use
+        if self.contours is None:
+            if not isinstance(self.mask, np.memmap):
+                contours, hierarchy = cv2.findContours(self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE,
+                                                       offset=self.offset)
+            else:
+                # a mask on disk is traced by the bands of rows with defects, never read whole
+                contours = []
+                for start, stop in self.get_bands() if len(self) > 0 else []:
+                    band_contours, hierarchy = cv2.findContours(np.ascontiguousarray(self.mask[start:stop]),
+                                                                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE,
+                                                                offset=(self.offset[0], self.offset[1] + start))
+                    contours.extend(band_contours)
+            self.contours = sort_contours(contours)
+        return self.contours
+
+
+def sort_contours(contours_) -> list:
+    # one order whatever way the mask was traced, anti-aliased outlines drawn over each other depend on it,
+    # a contour starts at the top left pixel of its defect, which no other defect has
+    return sorted(contours_, key=lambda contour: (int(contour[0, 0, 1]), int(contour[0, 0, 0])))
+
+
+def get_dust_mask(image, dust_thresh_):
+    img_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    ret, thresh = cv2.threshold(img_gray, dust_thresh_, 255, cv2.THRESH_BINARY)
+    return img_gray, thresh
+
+
+def get_row_segments(thresh) -> list:
+    # a defect never crosses an empty row, so the runs of rows with bright pixels are labeled apart
+    rows = np.flatnonzero(thresh.max(axis=1))
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) > 1)
+    return list(zip(rows[np.r_[0, breaks + 1]].tolist(), (rows[np.r_[breaks, len(rows) - 1]] + 1).tolist()))
+
+
+def label_tile(image, dust_thresh_) -> tuple:
+    img_gray, thresh = get_dust_mask(image, dust_thresh_)
+    segments = []
+    for start, stop in get_row_segments(thresh):
+        n, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            thresh[start:stop], 8, cv2.CV_32S, cv2.CCL_GRANA)
+        is_bright = thresh[start:stop].ravel() != 0
+        brightness = np.bincount(labels.ravel()[is_bright], weights=img_gray[start:stop].ravel()[is_bright],
+                                 minlength=n)
+        # row 0 is the background, sums are of x, y and brightness over the defect pixels
+        stats[:, cv2.CC_STAT_TOP] += start
+        centroids[:, 1] += start
+        sums = np.c_[centroids * stats[:, cv2.CC_STAT_AREA, None], brightness]
+        segments.append((start, labels, stats[1:], sums[1:]))
+    return image.shape[:2], segments
+
+
+def get_tile_bounds(height, tile_rows_: int = cf.DUST_TILE_ROWS) -> list:
+    return [(start, min(start + tile_rows_, height)) for start in range(0, height, tile_rows_)]
+
+
+class DustDetector:
+    def __init__(self, dust_thresh_, dust_min_area_, offset_=(0, 0)):
+        self.dust_thresh = dust_thresh_
+        self.dust_min_area = dust_min_area_
+        self.offset = offset_
+        self.height = 0
+        self.width = 0
+        self.segments = []
+        self.stats = []
+        self.sums = []
+        # defects of all tiles get ids in one union-find forest, id 0 is the background
+        self.parent = np.zeros(1, np.int64)
+        self.last_row = None
+        self.labels = None
+        self.labels_rows = 0
+
+    def add_rows(self, image) -> None:
+        if len(image) > 0:
+            self.add_tile(label_tile(image, self.dust_thresh))
+
+    def add_tile(self, tile_: tuple) -> None:
+        (height, self.width), segments = tile_
+        last_row = None
+        for start, labels, stats, sums in segments:
+            base = len(self.parent) - 1
+            stats = stats.copy()
+            stats[:, cv2.CC_STAT_TOP] += self.height
+            sums = sums.copy()
+            sums[:, 1] += self.height * stats[:, cv2.CC_STAT_AREA]
+            self.parent = np.r_[self.parent, np.arange(base + 1, base + len(stats) + 1)]
+            # only defects touching the border of two tiles may be split between them
+            if start == 0 and self.last_row is not None:
+                self._merge(self.last_row, np.where(labels[0] != 0, labels[0] + base, 0))
+            if start + len(labels) == height:
+                last_row = np.where(labels[-1] != 0, labels[-1] + base, 0)
+            self.segments.append((self.height + start, self._keep_labels(labels), base, len(stats)))
+            self.stats.append(stats)
+            self.sums.append(sums)
+        self.last_row = last_row
+        self.height += height
+
+    def _keep_labels(self, labels_):
+        if not scratch_store.is_enabled:
+            return labels_
+        # on disk the labels of all segments go one after another into a single file
+        rows = self.labels_rows + len(labels_)
+        if self.labels is None:
+            self.labels = scratch_store.empty((max(rows, scratch_store.block_rows), labels_.shape[1]), labels_.dtype,
+                                              'labels')
+        elif rows > len(self.labels):
+            self.labels = scratch_store.grow(self.labels, max(rows, 2 * len(self.labels)), 'labels')
+        self.labels[self.labels_rows:rows] = labels_
+        self.labels_rows = rows
+        return rows - len(labels_), rows
+
+    def _find(self, id_: int) -> int:
+        while self.parent[id_] != id_:
+            self.parent[id_] = self.parent[self.parent[id_]]
+            id_ = self.parent[id_]
+        return id_
+
+    def _merge(self, upper_, lower_) -> None:
+        # with 8-connectivity a pixel touches the three pixels under it
+        width = len(upper_)
+        pairs = [np.c_[upper_[max(0, -dx):width - max(0, dx)], lower_[max(0, dx):width - max(0, -dx)]]
+                 for dx in (-1, 0, 1)]
+        pairs = np.concatenate(pairs)
+        pairs = np.unique(pairs[(pairs[:, 0] != 0) & (pairs[:, 1] != 0)], axis=0)
+        for upper_id, lower_id in pairs.tolist():
+            upper_root, lower_root = self._find(upper_id), self._find(lower_id)
+            if upper_root != lower_root:
+                self.parent[max(upper_root, lower_root)] = min(upper_root, lower_root)
+
+    def get_table(self) -> DustTable:
+        roots = self.parent
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        count = len(roots)
+        mask = scratch_store.zeros((self.height, self.width), np.uint8, 'mask')
+        if count == 1:
+            return DustTable(np.zeros((0, 5), np.int32), np.zeros((0, 2)), np.zeros(0, np.float32), mask, self.offset)
+
+        stats = np.concatenate(self.stats)
+        sums = np.concatenate(self.sums)
+        ids = roots[1:]
+        area = np.bincount(ids, weights=stats[:, cv2.CC_STAT_AREA], minlength=count).astype(np.int64)
+        left = np.full(count, np.iinfo(np.int64).max)
+        top = left.copy()
+        right = np.zeros(count, np.int64)
+        bottom = right.copy()
+        np.minimum.at(left, ids, stats[:, cv2.CC_STAT_LEFT])
+        np.minimum.at(top, ids, stats[:, cv2.CC_STAT_TOP])
+        np.maximum.at(right, ids, stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH])
+        np.maximum.at(bottom, ids, stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT])
+        sums = np.stack([np.bincount(ids, weights=sums[:, i], minlength=count) for i in range(3)], axis=1)
+
+        is_dust = area > self.dust_min_area
+        is_dust[0] = False
+        lut = is_dust[roots].astype(np.uint8) * 255
+        for start, labels, base, n in self.segments:
+            tile_lut = np.r_[0, lut[base + 1:base + n + 1]].astype(np.uint8)
+            if tile_lut.any():
+                if isinstance(labels, tuple):
+                    labels = self.labels[labels[0]:labels[1]]
+                mask[start:start + len(labels)] = tile_lut[labels]
+
+        area = area[is_dust]
+        table_stats = np.c_[left[is_dust], top[is_dust], right[is_dust] - left[is_dust],
+                            bottom[is_dust] - top[is_dust], area].astype(np.int32)
+        return DustTable(table_stats, sums[is_dust, :2] / area[:, None], (sums[is_dust, 2] / area).astype(np.float32),
+                         mask, self.offset)
+
+
+def detect_dust(image, dust_thresh_, dust_min_area_, offset_=(0, 0), workers_: int = cf.DUST_WORKERS) -> DustTable:
+    detector = DustDetector(dust_thresh_, dust_min_area_, offset_)
+    tiles = [image[start:stop] for start, stop in get_tile_bounds(image.shape[0])]
+    if workers_ > 1 and len(tiles) > 1:
+        # opencv releases the GIL, the tiles are labeled on threads and joined in order
+        with ThreadPoolExecutor(max_workers=workers_) as executor:
+            for tile in executor.map(label_tile, tiles, [dust_thresh_] * len(tiles)):
+                detector.add_tile(tile)
+    else:
+        for tile in tiles:
+            detector.add_rows(tile)
+    return detector.get_table()
+
+
+def get_dust_roi(origin_img) -> tuple:
+    # dust is searched in the middle band of the unrolled tube
+    offset = origin_img.shape[1] * 970 // 2240
+    return origin_img[0:origin_img.shape[0], offset: origin_img.shape[1] * 1570 // 2240], (offset, 0)
+
+
+def detect_map_dust(origin_img, dust_thresh_, dust_min_area_) -> DustTable:
+    image, offset = get_dust_roi(origin_img)
+    return detect_dust(image, dust_thresh_, dust_min_area_, offset)
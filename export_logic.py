@@ -0,0 +1,53 @@
+import time
+import pathlib
+import cv2
+import config as cf
+from scratch_store import scratch_store
+
+
+def get_encode_params(ext_: str, png_compression_: int, jpeg_quality_: int) -> list:
+    if ext_ == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression_]
+    if ext_ in ('.jpg', '.jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality_]
+    raise ValueError(f'Unsupported image format: {ext_}')
+
+
+def get_chunk_path(path_, index_: int) -> pathlib.Path:
+    path = pathlib.Path(path_)
+    return path.with_name(f'{path.stem}.{index_:03d}{path.suffix}')
+
+
+def get_export_paths(path_, rows_: int, max_rows_: int = cf.EXPORT_MAX_ROWS) -> list:
+    # maps too tall for one image are written as numbered bands of rows
+    if rows_ <= max_rows_:
+        return [pathlib.Path(path_)]
+    return [get_chunk_path(path_, i) for i in range((rows_ + max_rows_ - 1) // max_rows_)]
+
+
+def get_bgr(img_):
+    if not scratch_store.is_enabled:
+        return cv2.cvtColor(img_, cv2.COLOR_RGB2BGR)
+    # the band to encode is converted block by block into a file
+    img = scratch_store.empty(img_.shape, img_.dtype, 'export')
+    for start, stop in scratch_store.get_blocks(len(img_)):
+        cv2.cvtColor(img_[start:stop], cv2.COLOR_RGB2BGR, dst=img[start:stop])
+    return img
+
+
+def export_map(img, path_, png_compression_: int = cf.EXPORT_PNG_COMPRESSION,
+               jpeg_quality_: int = cf.EXPORT_JPEG_QUALITY, max_rows_: int = cf.EXPORT_MAX_ROWS) -> tuple:
+    start_time = time.perf_counter()
+    paths = get_export_paths(path_, img.shape[0], max_rows_)
+    params = get_encode_params(paths[0].suffix.lower(), png_compression_, jpeg_quality_)
+    nbytes = 0
+    for i, path in enumerate(paths):
+        # maps are RGB, opencv encodes BGR
+        ret, buffer = cv2.imencode(path.suffix, get_bgr(img[i * max_rows_:(i + 1) * max_rows_]), params)
+        if not ret:
+            raise IOError(f"Can't encode {path}")
+        # written by python, so paths with any characters work on every platform
+        with open(path, 'wb') as file:
+            file.write(buffer)
+        nbytes += len(buffer)
+    return paths, time.perf_counter() - start_time, nbytes
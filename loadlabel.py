@@ -1,7 +1,10 @@
 import functools
+import threading
+from concurrent.futures import CancelledError
 from PySide6.QtWidgets import QWidget, QLabel, QMessageBox
 from PySide6.QtGui import QMovie
-from PySide6.QtCore import Qt, QSize, QObject, QThread, Signal
+from PySide6.QtCore import Qt, QSize, QObject, QRunnable, QThreadPool, Signal
+import config as cf
 
 
 class MyWarning(Warning):
@@ -44,7 +47,6 @@ class LoadLabel(QLabel):
     def __init__(self, parent_: QWidget = None):
         super().__init__(parent_)
         self.setWindowFlag(Qt.FramelessWindowHint)
-        self.setWindowModality(Qt.ApplicationModal)
         self.setScaledContents(True)
         self.setMaximumWidth(200)
 
@@ -66,90 +68,133 @@ class LoadLabel(QLabel):
         self.close()
 
 
-class LoadWorker(QObject):
-    exception_signal = Signal(str, str)
-    complete = Signal(list)
+class Job(QObject):
+    complete = Signal(object, object)
+    exception_signal = Signal(object, str, str)
+    cancelled = Signal(object)
+    progress = Signal(object, int, int)
 
-    def run(self, func_: classmethod, args: tuple, kwargs: dict) -> None:
+    def __init__(self, func_, args_: tuple, kwargs_: dict):
+        super().__init__()
+        self.func = func_
+        self.args = args_
+        self.kwargs = kwargs_
+        self.cancel_event = threading.Event()
+        self.done = 0
+        self.total = 0
+
+        self.after_func = None
+        self.is_result_to_after = False
+        self.after_args = tuple()
+        self.after_kwargs = dict()
+
+    def after_work(self, after_func_, is_result_to_after_: bool = False, *args, **kwargs) -> None:
+        self.after_func = after_func_
+        self.is_result_to_after = is_result_to_after_
+        self.after_args = args
+        self.after_kwargs = kwargs
+
+    def report_progress(self, rows_, done_: int, total_: int) -> None:
+        self.done = done_
+        self.total = total_
+        self.progress.emit(rows_, done_, total_)
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def run(self) -> None:
+        if self.is_cancelled():
+            self.cancelled.emit(self)
+            return
         print("Start Work in other Thread")
         try:
-            result = func_(*args, **kwargs)
-            self.complete.emit([result])
+            result = self.func(*self.args, progress_=self.report_progress, cancel_=self.cancel_event, **self.kwargs)
+        except CancelledError:
+            self.cancelled.emit(self)
         except MyWarning as mw:
-            self.exception_signal.emit(mw.exception_title, mw.message)
+            self.exception_signal.emit(self, mw.exception_title, mw.message)
         except BaseException:
-            self.exception_signal.emit("Unknown warning", "Неизвестная ошибка при чтении файла.")
+            self.exception_signal.emit(self, "Unknown warning", "Неизвестная ошибка при чтении файла.")
+        else:
+            self.complete.emit(self, result)
+
 
+class JobRunnable(QRunnable):
+    def __init__(self, job_: Job):
+        super().__init__()
+        self.job = job_
 
-class LoadDirector(QObject):
-    work_inition = Signal(classmethod, tuple, dict)
+    def run(self) -> None:
+        self.job.run()
 
 
-class LoadThread:
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.is_busy = False
-        self.worker = LoadWorker()
-        self.director = LoadDirector()
+class JobScheduler(QObject):
+    def __init__(self):
+        if hasattr(self, 'jobs'):
+            return
+        super().__init__()
+        self.jobs = []
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(cf.JOB_WORKERS)
         self.load_label = LoadLabel()
-        self.work_thread = QThread()
-
-        self.worker.exception_signal.connect(self.exception)
-        self.worker.complete.connect(self.complete_work)
-        self.director.work_inition.connect(self.worker.run)
-        self.worker.moveToThread(self.work_thread)
 
-        self.after_func = None
-        self.is_result_to_after = False
-        self.after_args = tuple()
-        self.after_kwargs = dict()
+    def submit(self, job_: Job) -> Job:
+        job_.complete.connect(self.complete_work)
+        job_.exception_signal.connect(self.exception)
+        job_.cancelled.connect(self.cancelled_work)
+        if len(self.jobs) == 0:
+            self.load_label.run()
+        self.jobs.append(job_)
+        self.pool.start(JobRunnable(job_))
+        return job_
+
+    def cancel_all(self) -> None:
+        for job in self.jobs:
+            job.cancel()
+
+    def _finish(self, job_: Job) -> None:
+        if job_ in self.jobs:
+            self.jobs.remove(job_)
+        if len(self.jobs) == 0:
+            self.load_label.stop()
+
+    def exception(self, job_: Job, title_: str, message_: str) -> None:
+        self._finish(job_)
+        MessageBox().warning(title_, message_)
 
-    def start_worker(self, func_, *args, **kwargs) -> bool:
-        if self.is_busy:
-            return False
-        self.is_busy = True
-        self.work_thread.start()
-        self.load_label.run()
-        self.director.work_inition.emit(func_, args, kwargs)
-        return True
-
-    def after_work(self, other_, after_func_: str, is_result_to_after_: bool = False, *args, **kwargs) -> None:
-        self.after_func = None if after_func_ is None else getattr(other_, after_func_)
-        self.is_result_to_after = is_result_to_after_
-        self.after_args = args
-        self.after_kwargs = kwargs
+    def cancelled_work(self, job_: Job) -> None:
+        self._finish(job_)
+        print("Work cancelled")
 
-    def exception(self, title_: str, message_: str) -> None:
-        MessageBox().warning(title_, message_)
-        self.is_busy = False
-        self.load_label.stop()
-        self.work_thread.terminate()
-
-    def complete_work(self, list_result_: list) -> None:
-        work_result = list_result_[0]
-        self.is_busy = False
-        self.load_label.stop()
-        self.work_thread.terminate()
-        if self.after_func is not None:
-            if self.is_result_to_after:
-                self.after_func(work_result, *self.after_args, **self.after_kwargs)
+    def complete_work(self, job_: Job, work_result_) -> None:
+        self._finish(job_)
+        if job_.after_func is not None:
+            if job_.is_result_to_after:
+                job_.after_func(work_result_, *job_.after_args, **job_.after_kwargs)
             else:
-                self.after_func(*self.after_args, **self.after_kwargs)
+                job_.after_func(*job_.after_args, **job_.after_kwargs)
 
     def __new__(cls):
         if not hasattr(cls, 'instance'):
-            cls.instance = super(LoadThread, cls).__new__(cls)
+            cls.instance = super(JobScheduler, cls).__new__(cls)
         return cls.instance
 
 
-def loading(after_func_: str = None, is_result_to_it_: bool = False, *after_args, **after_kwargs):
+def loading(after_func_: str = None, is_result_to_it_: bool = False, *after_args, progress_func_: str = None,
+            **after_kwargs):
     def loading_decorator(func_):
         @functools.wraps(func_)
-        def wrapper(self, *args, **kwargs):
-            threads = LoadThread()
-            threads.after_work(self, after_func_, is_result_to_it_, *after_args, **after_kwargs)
-            threads.start_worker(func_, self, *args, **kwargs)
+        def wrapper(self, *args, **kwargs) -> Job:
+            job = Job(func_, (self,) + args, kwargs)
+            job.after_work(None if after_func_ is None else getattr(self, after_func_), is_result_to_it_,
+                           *after_args, **after_kwargs)
+            if progress_func_ is not None:
+                job.progress.connect(getattr(self, progress_func_))
+            return JobScheduler().submit(job)
 
         return wrapper
 
-    return loading_decorator
\ No newline at end of file
+    return loading_decorator
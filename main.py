@@ -1,6 +1,10 @@
-from video_logic import video_main
-from window_logic import window_main
+import sys
 
 
 if __name__ == '__main__':
-    window_main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        from video_logic import video_main
+        video_main(sys.argv[2:])
+    else:
+        from window_logic import window_main
+        window_main()
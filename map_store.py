@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+import pathlib
+import functools
+import numpy as np
+import config as cf
+
+
+@functools.lru_cache(maxsize=256)
+def _get_file_hash(path, size, mtime_ns) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_hash(path) -> str:
+    stat = os.stat(path)
+    return _get_file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class MapStore:
+    def __init__(self, root_: str = cf.MAP_STORE_PATH, max_bytes_: int = cf.MAP_STORE_MAX_BYTES):
+        self.root = pathlib.Path(root_)
+        self.max_bytes = max_bytes_
+
+    def get_key(self, video_path_, thickness_, frame_freq_, sample_ms_=None, is_stabilization_=False,
+                is_adaptive_=False) -> str:
+        step = f'f{frame_freq_}' if sample_ms_ is None else f'ms{sample_ms_}'
+        if is_adaptive_:
+            step = f'motion{cf.MOTION_TRAVEL * 100:.0f}'
+        # stabilized maps of another version of the stabilization are built again
+        return f'{get_file_hash(video_path_)}_t{thickness_}_{step}' + \
+            (f'_stab{cf.STAB_VERSION}' if is_stabilization_ else '')
+
+    def contains(self, key_: str) -> bool:
+        return (self.root / f'{key_}.npy').exists() and (self.root / f'{key_}.json').exists()
+
+    def load(self, key_: str):
+        path = self.root / f'{key_}.npy'
+        if not self.contains(key_):
+            return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def load_frames(self, key_: str) -> np.ndarray:
+        # source frame of every strip, maps stored before it was recorded have none
+        try:
+            return np.load(self.root / f'{key_}.frames.npy')
+        except (OSError, ValueError):
+            return np.zeros(0, np.int64)
+
+    def save(self, key_: str, img_: np.ndarray, meta_: dict, frames_: np.ndarray = None) -> np.ndarray:
+        self.root.mkdir(parents=True, exist_ok=True)
+        if frames_ is not None:
+            np.save(self.root / f'{key_}.frames.npy', frames_)
+        path = self.root / f'{key_}.npy'
+        # written under a temporary name so that other processes never load half a map
+        tmp_path = self.root / f'{key_}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.save(file, img_)
+        meta = dict(meta_, shape=list(img_.shape), dtype=str(img_.dtype), created=time.time())
+        with open(self.root / f'{key_}.json.{os.getpid()}.tmp', 'w') as file:
+            json.dump(meta, file, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        os.replace(self.root / f'{key_}.json.{os.getpid()}.tmp', self.root / f'{key_}.json')
+        self.evict(keep_=key_)
+        return np.load(path, mmap_mode='r')
+
+    def evict(self, keep_: str = None) -> None:
+        maps = []
+        for path in self.root.glob('*.npy'):
+            if path.name.endswith('.frames.npy'):
+                continue
+            try:
+                maps.append((path.stat().st_mtime, path.stat().st_size, path))
+            except FileNotFoundError:
+                pass
+        total = sum(size for _, size, _ in maps)
+        for _, size, path in sorted(maps):
+            if total <= self.max_bytes:
+                break
+            if path.stem == keep_:
+                continue
+            total -= size
+            path.unlink(missing_ok=True)
+            path.with_suffix('.json').unlink(missing_ok=True)
+            path.with_suffix('.frames.npy').unlink(missing_ok=True)
+
+
+map_store = MapStore()
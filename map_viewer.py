@@ -0,0 +1,223 @@
+from PySide6.QtWidgets import QWidget, QAbstractScrollArea
+from PySide6.QtGui import QPainter, QImage, QPen, QColor, QPolygonF, QTransform
+from PySide6.QtCore import Qt, QPointF, QRectF
+import config as cf
+
+
+def m_log2(value_: int) -> int:
+    return max(value_, 1).bit_length() - 1
+
+
+def get_level_img(img, level_: int):
+    import cv2
+
+    height, width = img.shape[:2]
+    size = (max(width >> level_, 1), max(height >> level_, 1))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def get_half_level(img):
+    import numpy as np
+    import cv2
+    from scratch_store import scratch_store
+
+    # a map on disk is halved by blocks of an even number of rows into another file
+    height, width = img.shape[:2]
+    level = scratch_store.empty((max(height >> 1, 1), max(width >> 1, 1)) + img.shape[2:], img.dtype, 'level')
+    block_rows = scratch_store.block_rows & ~1
+    for start in range(0, len(level) * 2, block_rows):
+        stop = min(start + block_rows, len(level) * 2)
+        level[start >> 1:stop >> 1] = cv2.resize(np.ascontiguousarray(img[start:stop]),
+                                                 (level.shape[1], (stop - start) >> 1), interpolation=cv2.INTER_AREA)
+    return level
+
+
+def img_to_qimage(img) -> QImage:
+    # the image only wraps the array memory, the array has to outlive it
+    return QImage(img.data, img.shape[1], img.shape[0], img.strides[0], QImage.Format_RGB888)
+
+
+class MapPyramid:
+    def __init__(self, img_, tile_size_: int = cf.VIEWER_TILE_SIZE, size_=None):
+        import numpy as np
+
+        self.levels = [np.ascontiguousarray(img_)]
+        self.tile_size = tile_size_
+        self.tiles = dict()
+        # a preview stands for a bigger map, it is drawn stretched over the size of that one
+        self.size = (img_.shape[1], img_.shape[0]) if size_ is None else tuple(size_)
+
+    def get_level(self, level_: int):
+        from scratch_store import scratch_store
+
+        while len(self.levels) <= level_:
+            if scratch_store.is_enabled:
+                self.levels.append(get_half_level(self.levels[-1]))
+            else:
+                self.levels.append(get_level_img(self.levels[-1], 1))
+        return self.levels[level_]
+
+    def get_level_scale(self, level_: int) -> tuple:
+        # map pixels per pixel of the level, across and along the map
+        height, width = self.get_level(level_).shape[:2]
+        return self.size[0] / width, self.size[1] / height
+
+    def is_stretched(self) -> bool:
+        return self.size != (self.levels[0].shape[1], self.levels[0].shape[0])
+
+    def get_levels_count(self) -> int:
+        height, width = self.levels[0].shape[:2]
+        return m_log2(min(width, height) // cf.VIEWER_MIN_LEVEL_SIZE) + 1
+
+    def get_tile(self, level_: int, row_: int) -> tuple:
+        # a tile is a band of whole rows, so it stays a contiguous view of the level array
+        key = (level_, row_)
+        if key not in self.tiles:
+            img = self.get_level(level_)[row_ * self.tile_size:(row_ + 1) * self.tile_size]
+            self.tiles[key] = (img, img_to_qimage(img))
+        return self.tiles[key]
+
+    def get_size(self) -> tuple:
+        return self.size
+
+
+class MapViewer(QAbstractScrollArea):
+    def __init__(self, parent_: QWidget = None):
+        super().__init__(parent_)
+        self.pyramid = None
+        self.scale = 1.
+        self.is_fit = True
+        self.overlay = []
+        self.is_overlay_visible = True
+        self.overlay_pen = QPen(QColor(*cf.VIEWER_OVERLAY_COLOR))
+        self.overlay_pen.setCosmetic(True)
+        self.drag_pos = None
+        self.viewport().setCursor(Qt.OpenHandCursor)
+
+    def set_img(self, img_, is_keep_view_: bool = False, size_=None) -> None:
+        self.pyramid = MapPyramid(img_, size_=size_)
+        if not is_keep_view_ or self.is_fit:
+            self.is_fit = True
+            self.scale = self.get_fit_scale()
+        self._update_scrollbars()
+        if not is_keep_view_:
+            self.verticalScrollBar().setValue(0)
+        self.viewport().update()
+
+    def set_overlay(self, contours_) -> None:
+        self.overlay = []
+        for contour in contours_:
+            points = contour.reshape(-1, 2)
+            polygon = QPolygonF([QPointF(x + .5, y + .5) for x, y in points.tolist()])
+            polygon.append(polygon.first())
+            self.overlay.append((polygon.boundingRect(), polygon))
+        self.viewport().update()
+
+    def set_overlay_visible(self, is_visible_: bool) -> None:
+        self.is_overlay_visible = bool(is_visible_)
+        self.viewport().update()
+
+    def clear(self) -> None:
+        self.pyramid = None
+        self.overlay = []
+        self._update_scrollbars()
+        self.viewport().update()
+
+    def get_fit_scale(self) -> float:
+        if self.pyramid is None:
+            return 1.
+        return self.viewport().width() / self.pyramid.get_size()[0]
+
+    def set_scale(self, scale_: float, anchor_: QPointF = None) -> None:
+        if self.pyramid is None:
+            return
+        if anchor_ is None:
+            anchor_ = QPointF(self.viewport().width() / 2, self.viewport().height() / 2)
+        fit = self.get_fit_scale()
+        scale = min(max(scale_, fit * cf.VIEWER_MIN_ZOOM), cf.VIEWER_MAX_ZOOM)
+        # the map point under the anchor stays in place
+        map_x = (self.horizontalScrollBar().value() + anchor_.x()) / self.scale
+        map_y = (self.verticalScrollBar().value() + anchor_.y()) / self.scale
+        self.scale = scale
+        self.is_fit = scale == fit
+        self._update_scrollbars()
+        self.horizontalScrollBar().setValue(round(map_x * scale - anchor_.x()))
+        self.verticalScrollBar().setValue(round(map_y * scale - anchor_.y()))
+        self.viewport().update()
+
+    def _update_scrollbars(self) -> None:
+        width, height = (0, 0) if self.pyramid is None else self.pyramid.get_size()
+        view = self.viewport().size()
+        self.horizontalScrollBar().setRange(0, max(0, round(width * self.scale) - view.width()))
+        self.horizontalScrollBar().setPageStep(view.width())
+        self.verticalScrollBar().setRange(0, max(0, round(height * self.scale) - view.height()))
+        self.verticalScrollBar().setPageStep(view.height())
+        self.verticalScrollBar().setSingleStep(cf.VIEWER_SCROLL_STEP)
+
+    def get_visible_rect(self) -> QRectF:
+        return QRectF(self.horizontalScrollBar().value() / self.scale, self.verticalScrollBar().value() / self.scale,
+                      self.viewport().width() / self.scale, self.viewport().height() / self.scale)
+
+    def paintEvent(self, event_) -> None:
+        painter = QPainter(self.viewport())
+        painter.fillRect(self.viewport().rect(), self.palette().window())
+        if self.pyramid is None:
+            return
+        visible = self.get_visible_rect()
+        to_view = QTransform().translate(-self.horizontalScrollBar().value(), -self.verticalScrollBar().value())
+        painter.setTransform(QTransform().scale(self.scale, self.scale) * to_view)
+
+        # the map is drawn from the smallest level that is still not upscaled
+        scale = self.scale * self.pyramid.get_level_scale(0)[0]
+        level = min(m_log2(int(1 / scale)) if scale < 1 else 0, self.pyramid.get_levels_count() - 1)
+        scale_x, scale_y = self.pyramid.get_level_scale(level)
+        level_height = self.pyramid.get_level(level).shape[0]
+        tile_size = self.pyramid.tile_size
+        x0, x1 = visible.left() / scale_x, visible.right() / scale_x
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, scale < 1 or self.pyramid.is_stretched())
+        for row in range(max(0, int(visible.top() / scale_y) // tile_size),
+                         min(level_height - 1, int(visible.bottom() / scale_y)) // tile_size + 1):
+            img, qimage = self.pyramid.get_tile(level, row)
+            source = QRectF(x0, 0, x1 - x0, img.shape[0]).intersected(QRectF(0, 0, img.shape[1], img.shape[0]))
+            target = QRectF(source.left() * scale_x, (row * tile_size + source.top()) * scale_y,
+                            source.width() * scale_x, source.height() * scale_y)
+            painter.drawImage(target, qimage, source)
+
+        if self.is_overlay_visible:
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setPen(self.overlay_pen)
+            for rect, polygon in self.overlay:
+                if rect.intersects(visible):
+                    painter.drawPolyline(polygon)
+
+    def resizeEvent(self, event_) -> None:
+        super().resizeEvent(event_)
+        if self.is_fit:
+            self.scale = self.get_fit_scale()
+        self._update_scrollbars()
+
+    def wheelEvent(self, event_) -> None:
+        if event_.modifiers() & Qt.ControlModifier:
+            self.set_scale(self.scale * cf.VIEWER_ZOOM_STEP ** (event_.angleDelta().y() / 120), event_.position())
+            event_.accept()
+        else:
+            super().wheelEvent(event_)
+
+    def mousePressEvent(self, event_) -> None:
+        if event_.button() == Qt.LeftButton:
+            self.drag_pos = event_.position()
+            self.viewport().setCursor(Qt.ClosedHandCursor)
+
+    def mouseMoveEvent(self, event_) -> None:
+        if self.drag_pos is not None:
+            delta = event_.position() - self.drag_pos
+            self.drag_pos = event_.position()
+            self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() - round(delta.x()))
+            self.verticalScrollBar().setValue(self.verticalScrollBar().value() - round(delta.y()))
+
+    def mouseReleaseEvent(self, event_) -> None:
+        self.drag_pos = None
+        self.viewport().setCursor(Qt.OpenHandCursor)
+
+    def mouseDoubleClickEvent(self, event_) -> None:
+        self.set_scale(self.get_fit_scale(), event_.position())
@@ -0,0 +1,62 @@
+import time
+import functools
+import cv2
+import numpy as np
+import config as cf
+
+
+@functools.lru_cache(maxsize=4)
+def get_ring_weights(size_):
+    # weights of the x and y flow of every pixel, together they give the mean outward move at the frame sides
+    width, height = size_
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    x -= (width - 1) / 2
+    y -= (height - 1) / 2
+    radius = np.maximum(np.sqrt(x * x + y * y), 1)
+    edge = min(width, height) / 2
+    ring = (radius >= edge * (1 - cf.MOTION_RING)) & (radius < edge)
+    # in a straight tube the wall moves by the square of the distance from the centre
+    weight = np.where(ring, (edge / radius) ** 2 / ring.sum(), 0) / radius
+    weights = np.stack((x * weight, y * weight), axis=2).astype(np.float32).ravel()
+    weights.setflags(write=False)
+    return weights
+
+
+class MotionSampler:
+    def __init__(self, thickness_: int, img_size_=cf.IMG_SIZE, travel_: float = cf.MOTION_TRAVEL):
+        # a strip is taken once the wall at the slice moved by its thickness
+        self.step = thickness_ * travel_
+        self.scale = min(img_size_) / min(cf.MOTION_SIZE)
+        self.flow = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+        self.travel = 0.
+        self.key = None
+        self.frames = 0
+        self.sampled = 0
+        self.seconds = 0.
+
+    def get_travel(self, key_, small_) -> float:
+        flow = self.flow.calc(key_, small_, None)
+        # pixels of the map the wall moved by at the middle of the frame sides, in or out of the tube
+        return abs(float(flow.ravel() @ get_ring_weights(cf.MOTION_SIZE))) * self.scale
+
+    def update(self, frame) -> bool:
+        start_time = time.perf_counter()
+        small = cv2.cvtColor(cv2.resize(frame, cf.MOTION_SIZE, interpolation=cv2.INTER_LINEAR), cv2.COLOR_BGR2GRAY)
+        # frames are compared with the last sampled one, so a slow probe adds up to a strip as well
+        is_sample = self.key is None
+        if not is_sample:
+            travel = self.get_travel(self.key, small)
+            # the strip is taken from the frame closest to the step, the next one is expected half a move further
+            is_sample = travel + (travel - self.travel) / 2 >= self.step
+            self.travel = travel
+        if is_sample:
+            self.key = small
+            self.travel = 0.
+        self.frames += 1
+        self.sampled += is_sample
+        self.seconds += time.perf_counter() - start_time
+        return is_sample
+
+    def get_record(self) -> dict:
+        return {'frames': self.frames, 'sampled': int(self.sampled),
+                'ms_per_frame': self.seconds * 1000 / max(self.frames, 1)}
@@ -0,0 +1,126 @@
+import time
+import queue
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import config as cf
+
+_END = object()
+
+
+class PipelineStats:
+    def __init__(self, threads_: int = cf.PIPELINE_THREADS):
+        # seconds every stage spent working and waiting on the others
+        self.threads = threads_
+        self.busy = dict.fromkeys(('decode', 'slice', 'assemble'), 0.)
+        self.wait = dict.fromkeys(('decode', 'assemble'), 0.)
+        self.strips = 0
+        self.seconds = 0.
+        self.lock = threading.Lock()
+
+    def add_busy(self, stage_: str, seconds_: float) -> None:
+        with self.lock:
+            self.busy[stage_] += seconds_
+
+    def get_utilization(self) -> dict:
+        # the share of the run every stage was busy, the slicing one over all its threads
+        seconds = max(self.seconds, 1e-9)
+        return {'decode': self.busy['decode'] / seconds,
+                'slice': self.busy['slice'] / (max(self.threads, 1) * seconds),
+                'assemble': self.busy['assemble'] / seconds}
+
+    def get_record(self) -> dict:
+        utilization = self.get_utilization()
+        seconds = max(self.seconds, 1e-9)
+        return {'threads': self.threads, 'strips': self.strips, 'seconds': self.seconds, 'busy': utilization,
+                'blocked': {stage: wait / seconds for stage, wait in self.wait.items()},
+                'bottleneck': max(utilization, key=utilization.get)}
+
+
+def get_strips(frames_, slice_func_, prepare_func_=None):
+    # the same steps one after another on the calling thread
+    with contextlib.closing(frames_):
+        for frame in frames_:
+            yield slice_func_(frame) if prepare_func_ is None else slice_func_(frame, prepare_func_(frame))
+
+
+def run_pipeline(frames_, slice_func_, prepare_func_=None, threads_: int = cf.PIPELINE_THREADS,
+                 depth_: int = cf.PIPELINE_DEPTH, stats_: PipelineStats = None):
+    # a decoder thread fills a bounded queue of frames, a pool of threads cuts the strips,
+    # the caller gets them back in the order of the frames
+    stats = PipelineStats(threads_) if stats_ is None else stats_
+    frames = queue.Queue(depth_)
+    stop_event = threading.Event()
+
+    def put(item_) -> None:
+        start_time = time.perf_counter()
+        while not stop_event.is_set():
+            try:
+                frames.put(item_, timeout=cf.PIPELINE_POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        stats.wait['decode'] += time.perf_counter() - start_time
+
+    def decode() -> None:
+        # the frames and the steps following the camera frame by frame stay on this thread, in order
+        try:
+            with contextlib.closing(frames_):
+                while not stop_event.is_set():
+                    start_time = time.perf_counter()
+                    frame = next(frames_, _END)
+                    if frame is _END:
+                        break
+                    item = (frame,) if prepare_func_ is None else (frame, prepare_func_(frame))
+                    stats.add_busy('decode', time.perf_counter() - start_time)
+                    put(item)
+        except BaseException as e:
+            put(e)
+        finally:
+            put(_END)
+
+    def cut(item_):
+        start_time = time.perf_counter()
+        strip = slice_func_(*item_)
+        stats.add_busy('slice', time.perf_counter() - start_time)
+        return strip
+
+    start_time = time.perf_counter()
+    decoder = threading.Thread(target=decode, name='pipeline decoder', daemon=True)
+    decoder.start()
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max(threads_, 1), thread_name_prefix='pipeline slice') as executor:
+            is_end = False
+            while not is_end or len(pending) > 0:
+                # frames are handed to the pool while there is room, without waiting if strips are ready
+                while not is_end and len(pending) < depth_:
+                    wait_time = time.perf_counter()
+                    try:
+                        item = frames.get(block=len(pending) == 0)
+                    except queue.Empty:
+                        break
+                    stats.wait['assemble'] += time.perf_counter() - wait_time
+                    if item is _END:
+                        is_end = True
+                    elif isinstance(item, BaseException):
+                        raise item
+                    else:
+                        pending.append(executor.submit(cut, item))
+                if len(pending) == 0:
+                    continue
+                wait_time = time.perf_counter()
+                strip = pending.popleft().result()
+                stats.wait['assemble'] += time.perf_counter() - wait_time
+                stats.strips += 1
+                # the time the caller takes with a strip is the assembly
+                busy_time = time.perf_counter()
+                yield strip
+                stats.add_busy('assemble', time.perf_counter() - busy_time)
+    finally:
+        stop_event.set()
+        for future in pending:
+            future.cancel()
+        decoder.join()
+        stats.seconds = time.perf_counter() - start_time
@@ -0,0 +1,118 @@
+import sys
+import json
+import time
+import pathlib
+import cProfile
+import contextlib
+import tracemalloc
+import config as cf
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_max_rss_mib():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+class RunStats:
+    def __init__(self, name_: str, is_enabled_: bool = cf.STATS_ENABLED, profile_path_=None):
+        self.name = name_
+        self.is_enabled = is_enabled_
+        self.profile_path = profile_path_
+        self.stages = []
+        self.record = None
+        self.start_time = time.perf_counter()
+        # tracing is process wide, only the run that started it stops it
+        self.is_tracing = is_enabled_ and cf.STATS_TRACE_MEMORY and not tracemalloc.is_tracing()
+        if self.is_tracing:
+            tracemalloc.start()
+        self.profiler = None
+        if profile_path_ is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name_: str):
+        if not self.is_enabled:
+            yield dict()
+            return
+        record = {'stage': name_}
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start_time
+            if record.get('frames'):
+                record['fps'] = record['frames'] / max(record['seconds'], 1e-9)
+            if tracemalloc.is_tracing():
+                record['peak_mib'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            self.stages.append(record)
+
+    def stop_profile(self) -> None:
+        # the profiler only sees the thread that started it and has to be stopped there
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        pathlib.Path(self.profile_path).parent.mkdir(parents=True, exist_ok=True)
+        self.profiler.dump_stats(self.profile_path)
+        self.profiler = None
+        print(f"Profile saved to {self.profile_path}")
+
+    def finish(self, **fields):
+        self.stop_profile()
+        if self.is_tracing:
+            tracemalloc.stop()
+            self.is_tracing = False
+        if not self.is_enabled:
+            return None
+        self.record = {'run': self.name, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'seconds': time.perf_counter() - self.start_time, 'max_rss_mib': get_max_rss_mib(),
+                       'stages': self.stages, **fields}
+        if self.profile_path is not None:
+            self.record['profile'] = str(self.profile_path)
+        return self.record
+
+    def log(self, path_: str = cf.STATS_LOG_PATH) -> None:
+        if self.record is not None:
+            write_record(self.record, path_)
+            print(self)
+
+    def __str__(self) -> str:
+        return format_stages(self.stages, time.perf_counter() - self.start_time if self.record is None else
+                             self.record['seconds'])
+
+
+def get_profile_path(name_: str) -> pathlib.Path:
+    return pathlib.Path(cf.PROFILE_PATH) / f"{pathlib.Path(name_).stem} {time.strftime('%Y%m%d-%H%M%S')}.prof"
+
+
+def write_record(record_: dict, path_: str = cf.STATS_LOG_PATH) -> None:
+    # one json line per run
+    pathlib.Path(path_).parent.mkdir(parents=True, exist_ok=True)
+    with open(path_, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record_, ensure_ascii=False) + '\n')
+
+
+def format_stages(stages_: list, seconds_: float) -> str:
+    parts = []
+    for record in stages_:
+        part = f"{record['stage']} {record['seconds']:.2f} s"
+        if 'fps' in record:
+            part += f" ({record['fps']:.0f} fps)"
+        if record.get('is_cached'):
+            part += " (cache)"
+        parts.append(part)
+    total = f"{seconds_:.2f} s"
+    peak = max((record.get('peak_mib', 0) for record in stages_), default=0)
+    if peak > 0:
+        total += f", {peak:.0f} MiB"
+    return ' · '.join(parts) + ' | ' + total
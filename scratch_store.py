@@ -0,0 +1,74 @@
+import os
+import uuid
+import pathlib
+import numpy as np
+import config as cf
+
+
+def get_blocks(height, block_rows_: int = cf.BLOCK_ROWS) -> list:
+    return [(start, min(start + block_rows_, height)) for start in range(0, height, block_rows_)]
+
+
+class ScratchStore:
+    def __init__(self, root_: str = cf.SCRATCH_PATH, block_rows_: int = cf.BLOCK_ROWS,
+                 is_enabled_: bool = cf.OUT_OF_CORE):
+        # with the store enabled the big arrays of a run live in files, only blocks of rows are read at a time
+        self.root = pathlib.Path(root_)
+        self.block_rows = block_rows_
+        self.is_enabled = False
+        self.set_enabled(is_enabled_)
+
+    def set_enabled(self, is_enabled_: bool) -> None:
+        if is_enabled_ and not self.is_enabled:
+            self.clear()
+        self.is_enabled = bool(is_enabled_)
+
+    def get_blocks(self, height_: int) -> list:
+        return get_blocks(height_, self.block_rows)
+
+    def empty(self, shape_, dtype_=np.uint8, name_: str = 'array') -> np.ndarray:
+        if not self.is_enabled or np.prod(shape_) == 0:
+            return np.empty(shape_, dtype_)
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / f'{name_}.{os.getpid()}.{uuid.uuid4().hex}.npy'
+        img = np.lib.format.open_memmap(path, 'w+', dtype_, tuple(shape_))
+        # the mapping keeps the data, the disk space is freed with the array
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        return img
+
+    def zeros(self, shape_, dtype_=np.uint8, name_: str = 'array') -> np.ndarray:
+        if not self.is_enabled:
+            return np.zeros(shape_, dtype_)
+        # a new file reads as zeros
+        return self.empty(shape_, dtype_, name_)
+
+    def copy(self, img_, name_: str = 'copy') -> np.ndarray:
+        if not self.is_enabled:
+            return img_.copy()
+        img = self.empty(img_.shape, img_.dtype, name_)
+        for start, stop in self.get_blocks(len(img_)):
+            img[start:stop] = img_[start:stop]
+        return img
+
+    def grow(self, img_, rows_: int, name_: str = 'array') -> np.ndarray:
+        if not isinstance(img_, np.memmap):
+            img_.resize((rows_,) + img_.shape[1:], refcheck=False)
+            return img_
+        img = self.empty((rows_,) + img_.shape[1:], img_.dtype, name_)
+        for start, stop in self.get_blocks(min(rows_, len(img_))):
+            img[start:stop] = img_[start:stop]
+        return img
+
+    def clear(self) -> None:
+        # files of the arrays still mapped on systems that can not remove them at once
+        for path in self.root.glob('*.npy'):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+scratch_store = ScratchStore()
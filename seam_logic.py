@@ -0,0 +1,85 @@
+import functools
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import config as cf
+from scratch_store import scratch_store
+
+
+def get_edge_profiles(img_, tops_) -> tuple:
+    # the rows on both sides of every border of two blocks, the wall texture only goes on across a few rows
+    profiles = []
+    for rows in (tops_ - 1, tops_):
+        profiles.append(cv2.cvtColor(np.ascontiguousarray(img_[rows]), cv2.COLOR_RGB2GRAY).astype(np.float32))
+    return tuple(profiles)
+
+
+@functools.lru_cache(maxsize=4)
+def get_spectrum_weights(width_: int) -> tuple:
+    # rows are transformed into packed spectra, the real and imaginary parts of a frequency side by side
+    frequency = (np.arange(width_) + 1) // 2 / width_
+    # the shading across the tube leaves broad peaks, only details finer than ROTATE_HIGHPASS pixels are matched
+    highpass = (1 - np.exp(-2 * (np.pi * cf.ROTATE_HIGHPASS * frequency) ** 2)).astype(np.float32)
+    # every frequency but the constant and the last one of an even width stands for its conjugate as well
+    parseval = np.full(width_, 2 / width_, np.float32)
+    parseval[0] = 1 / width_
+    if width_ % 2 == 0:
+        parseval[-1] = 1 / width_
+    for weights in (highpass, parseval):
+        weights.setflags(write=False)
+    return highpass, parseval
+
+
+def get_block_shifts(upper_, lower_) -> np.ndarray:
+    # cross correlation of every block with the one above it, all borders in one batch of ffts
+    width = upper_.shape[1]
+    highpass, parseval = get_spectrum_weights(width)
+    upper = cv2.dft(upper_, flags=cv2.DFT_ROWS) * highpass
+    lower = cv2.dft(lower_, flags=cv2.DFT_ROWS) * highpass
+    norm = np.sqrt(((upper * upper) @ parseval) * ((lower * lower) @ parseval))
+    corr = cv2.idft(cv2.mulSpectrums(lower, upper, cv2.DFT_ROWS, conjB=True),
+                    flags=cv2.DFT_ROWS | cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE) / np.maximum(norm, 1e-6)[:, None]
+    rows = np.arange(len(corr))
+    peak = corr.argmax(axis=1)
+    response = corr[rows, peak]
+    # sub pixel position of the peak from a parabola through its neighbours
+    left, right = corr[rows, peak - 1], corr[rows, (peak + 1) % width]
+    curvature = left - 2 * response + right
+    shifts = peak + np.where(curvature < 0, (left - right) / np.minimum(curvature, -1e-6) / 2, 0)
+    shifts = (shifts + width / 2) % width - width / 2
+    # weak or far peaks are noise, the probe is taken as not rolling then
+    shifts[(response < cf.ROTATE_MIN_RESPONSE) | (np.abs(shifts) > cf.ROTATE_MAX_SHIFT * width)] = 0
+    return shifts
+
+
+def get_row_offsets(img_, block_rows_: int) -> np.ndarray:
+    # columns every row is rolled by to put the seam where it is in the first block,
+    # a block is the strip of one frame, so the probe only turns between two of them
+    height, width = img_.shape[:2]
+    tops = np.arange(block_rows_, height, block_rows_)
+    shifts = np.zeros(len(tops))
+    # the borders of a block of map rows at a time
+    step = max(1, scratch_store.block_rows // block_rows_)
+    for start in range(0, len(tops), step):
+        shifts[start:start + step] = get_block_shifts(*get_edge_profiles(img_, tops[start:start + step]))
+    path = np.r_[0, np.cumsum(shifts)]
+    return (np.rint(np.repeat(path, block_rows_)[:height]).astype(np.int64) % width).astype(np.int32)
+
+
+def roll_rows(img_, offsets_) -> np.ndarray:
+    # row r of the result is row r of the map started from column offsets_[r]
+    height, width = img_.shape[:2]
+    img = scratch_store.empty(img_.shape, img_.dtype, 'rotate')
+    pixel = int(np.prod(img_.shape[2:]))
+    for start, stop in scratch_store.get_blocks(height):
+        block = np.ascontiguousarray(img_[start:stop]).reshape(stop - start, width * pixel)
+        # every shifted row is a window of the row written twice, all of them are taken in one gather
+        windows = sliding_window_view(np.concatenate((block, block[:, :-pixel]), axis=1), width * pixel, axis=1)
+        img[start:stop] = windows[np.arange(stop - start), offsets_[start:stop] * pixel].reshape(
+            (stop - start,) + img_.shape[1:])
+    return img
+
+
+def get_true_columns(x_, y_, offsets_, width_):
+    # column in the aligned map of a point found at x_, y_ of the map as built
+    return (np.asarray(x_) - offsets_[np.asarray(y_, np.int64)]) % width_
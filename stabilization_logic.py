@@ -0,0 +1,59 @@
+import time
+import cv2
+import numpy as np
+import config as cf
+
+
+class Stabilizer:
+    def __init__(self, smoothing_: float = cf.STAB_SMOOTHING):
+        self.smoothing = smoothing_
+        self.prev = None
+        self.prev_polar = None
+        self.window = None
+        # camera path as x shift, y shift in pixels of IMG_SIZE and roll angle, and its smoothed version
+        self.trajectory = np.zeros(3)
+        self.smoothed = np.zeros(3)
+        self.frames = 0
+        self.seconds = 0.
+
+    def _get_polar(self, gray, dx_=0., dy_=0.):
+        height, width = gray.shape
+        # rows of the polar image are angles, a roll around the centre becomes a shift along them,
+        # the cost depends on the polar size only, so it is sampled from the full frame,
+        # a moved centre looks past the border, those samples are filled or they are left as garbage
+        return cv2.warpPolar(gray, (cf.STAB_RADIUS_BINS, cf.STAB_ANGLE_BINS),
+                             ((width - 1) / 2 + dx_, (height - 1) / 2 + dy_), min(width, height) / 2,
+                             cv2.WARP_POLAR_LINEAR | cv2.WARP_FILL_OUTLIERS).astype(np.float32)
+
+    def update(self, frame) -> tuple:
+        start_time = time.perf_counter()
+        # frames come as decoded, in BGR and at the source size
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, cf.STAB_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self.window is None:
+            self.window = cv2.createHanningWindow(small.shape[::-1], cv2.CV_32F)
+        if self.prev is not None:
+            (dx, dy), response = cv2.phaseCorrelate(self.prev, small, self.window)
+            # weak or far peaks are noise, the camera is taken as standing still then
+            if response < cf.STAB_MIN_RESPONSE or max(abs(dx), abs(dy)) > cf.STAB_MAX_SHIFT * small.shape[1]:
+                dx = dy = 0.
+            # the roll is measured around the point the centre of the previous frame moved to
+            (radius_shift, angle_shift), response = cv2.phaseCorrelate(
+                self.prev_polar, self._get_polar(gray, dx * gray.shape[1] / cf.STAB_SIZE[0],
+                                                 dy * gray.shape[0] / cf.STAB_SIZE[1]))
+            angle = angle_shift * 360. / cf.STAB_ANGLE_BINS
+            if response < cf.STAB_MIN_RESPONSE or abs(angle) > cf.STAB_MAX_ANGLE:
+                angle = 0.
+            self.trajectory += (dx * cf.IMG_SIZE[0] / cf.STAB_SIZE[0], dy * cf.IMG_SIZE[1] / cf.STAB_SIZE[1], angle)
+            self.smoothed += self.smoothing * (self.trajectory - self.smoothed)
+        self.prev, self.prev_polar = small, self._get_polar(gray)
+        self.frames += 1
+        self.seconds += time.perf_counter() - start_time
+        # the jitter is the part of the path the smoothed one does not follow
+        return tuple(self.trajectory - self.smoothed)
+
+    def get_frame_ms(self) -> float:
+        return self.seconds * 1000 / max(self.frames, 1)
+
+    def get_record(self) -> dict:
+        return {'frames': self.frames, 'ms_per_frame': self.get_frame_ms()}
@@ -0,0 +1,78 @@
+import os
+import pathlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import config as cf
+from map_store import map_store
+
+
+def get_video_key(path) -> tuple:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def is_stored(value) -> bool:
+    # maps of the map store are backed by its capped files, scratch arrays only live as long as they are held
+    if not isinstance(value, np.memmap) or value.filename is None:
+        return False
+    return map_store.root.resolve() in pathlib.Path(value.filename).resolve().parents
+
+
+def get_nbytes(value) -> int:
+    if is_stored(value):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(get_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+class StageCache:
+    def __init__(self, max_bytes_: int = cf.STAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes_
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key_: tuple, func_, *args, **kwargs):
+        with self.lock:
+            if key_ in self.items:
+                self.hits += 1
+                self.items.move_to_end(key_)
+                return self.items[key_][0]
+            self.misses += 1
+        value = func_(*args, **kwargs)
+        self.put(key_, value)
+        return value
+
+    def contains(self, key_: tuple) -> bool:
+        with self.lock:
+            return key_ in self.items
+
+    def put(self, key_: tuple, value_) -> None:
+        nbytes = get_nbytes(value_)
+        with self.lock:
+            if key_ in self.items:
+                self.nbytes -= self.items.pop(key_)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.nbytes + nbytes > self.max_bytes:
+                self.nbytes -= self.items.popitem(last=False)[1][1]
+            self.items[key_] = (value_, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def __str__(self) -> str:
+        return f"Stage cache: {self.hits} hits, {self.misses} misses, " \
+               f"{len(self.items)} items, {self.nbytes / 2 ** 20:.1f} MiB"
+
+
+stage_cache = StageCache()
@@ -0,0 +1,66 @@
+import os
+import sys
+import argparse
+import subprocess
+import config as cf
+
+HEAVY_MODULES = ('cv2', 'numpy', 'matplotlib', 'torch', 'torchvision', 'pandas', 'albumentations', 'tqdm')
+
+SHOW_WINDOW_CODE = """
+import sys, time
+start_time = time.perf_counter()
+from PySide6.QtWidgets import QApplication
+import window_logic
+app = QApplication([])
+main_window = window_logic.MainWindow(app)
+main_window.show()
+app.processEvents()
+print(time.perf_counter() - start_time)
+print(','.join(name for name in {modules} if name in sys.modules))
+"""
+
+
+def get_import_times(statement_: str) -> list:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement_], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), (len(name) - len(name.lstrip()) - 1) // 2, int(self_us), int(cumulative_us)))
+    return times
+
+
+def get_window_time() -> tuple:
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    result = subprocess.run([sys.executable, '-c', SHOW_WINDOW_CODE.format(modules=HEAVY_MODULES)], env=env,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = result.stdout.splitlines()
+    if result.returncode != 0 or len(lines) < 2:
+        raise RuntimeError(result.stderr)
+    return float(lines[0]) * 1000, [name for name in lines[1].split(',') if name]
+
+
+def startup_report(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Cold-start import report of the TubeMapping window.')
+    parser.add_argument('--budget-ms', type=float, default=cf.STARTUP_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args(argv)
+
+    times = get_import_times('import window_logic')
+    total_ms = sum(cumulative for _, depth, _, cumulative in times if depth == 0) / 1000
+    print('Module'.ljust(56), 'Self, ms'.rjust(10), 'Total, ms'.rjust(10))
+    for name, depth, self_us, cumulative_us in sorted(times, key=lambda item: -item[3])[:args.top]:
+        print(('  ' * depth + name).ljust(56), f'{self_us / 1000:10.1f}', f'{cumulative_us / 1000:10.1f}')
+    print(f'\nImports before the window: {total_ms:.1f} ms')
+
+    window_ms, heavy = get_window_time()
+    print(f'Window shown after: {window_ms:.1f} ms (budget {args.budget_ms:.0f} ms)')
+    if len(heavy) > 0:
+        print('Heavy modules loaded at startup:', ', '.join(heavy))
+    return 0 if window_ms <= args.budget_ms and len(heavy) == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(startup_report())
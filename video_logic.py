@@ -1,172 +1,695 @@
+import os
 import cv2
-import sys
+import json
+import argparse
+import time
+import functools
 import pathlib
-import pandas as pd
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError
 import numpy as np
-import matplotlib.pyplot as plt
-import albumentations as A
-from albumentations.pytorch import ToTensorV2
-from tqdm import tqdm
-from tqdm.contrib import tzip
 import config as cf
 import math as m
+from map_store import map_store
+from scratch_store import scratch_store
+from run_stats import RunStats, get_profile_path, write_record, format_stages
+from export_logic import export_map, get_chunk_path
+from dust_logic import detect_dust, detect_map_dust, get_dust_roi, DustDetector
+from stabilization_logic import Stabilizer
+from motion_logic import MotionSampler
+from seam_logic import get_row_offsets, roll_rows
+from pipeline_logic import PipelineStats, get_strips, run_pipeline
 
 
-def read_video(path, img_size, frames_freq=10):
-    frames = []
+def get_video_props(path):
     cap = cv2.VideoCapture(path)
-
     if not cap.isOpened():
-        print("Could not open video")
-        return []
+        return 0, 0.
+    length = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return length, fps
+
+
+def get_sampled_count(length, frames_freq=10, sample_ms=None, fps=0.):
+    if sample_ms is not None:
+        return 0 if length < 1 or fps <= 0 else int(length * 1000 / fps // sample_ms) + 1
+    return 0 if length < 2 else (length - 2) // frames_freq + 1
 
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
 
+def skip_frames(cap, position, target, length, is_seek_=True):
+    # seeking past the end is not reported by the backend, so near it the frames are grabbed
+    if is_seek_ and target - position >= cf.SEEK_MIN_STRIDE and target < length:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+        # the seek may land a frame off the target, the frame read next is the one the backend reports
+        return int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    while position < target and cap.grab():
+        position += 1
+    return position
+
+
+def prepare_frame(frame, img_size):
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return cv2.resize(frame, img_size)
+
+
+def read_video(path, img_size, frames_freq=10, sample_ms=None, sampler=None, frame_index=None):
+    # with img_size None the decoded BGR frames are given as they are
+    cap = cv2.VideoCapture(path)
+
+    if not cap.isOpened():
+        raise IOError(f"Could not open video {path}")
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
     length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     print("Initial frames num", length)
-    N = length // frames_freq
-    print("Step N", N)
+    print("Step N", get_sampled_count(length, frames_freq, sample_ms, fps))
 
-    current_frame = 1
-    for i in range(length):
-        ret, frame = cap.read(current_frame)
+    # timestamps are checked after a jump, while a frame index can only be trusted on exact seeking
+    is_seek = sample_ms is not None or cf.SEEK_BY_FRAMES
+    sampled = 0
+    start_time = time.perf_counter()
+    try:
+        position = 0
+        current_frame = 1
+        current_ms = 0.
+        while True:
+            if sample_ms is not None:
+                # jump close to the timestamp by the frame rate, then check the real timestamps
+                current_frame = max(position, int(current_ms * fps / 1000) - 1) if fps > 0 else position
+            position = skip_frames(cap, position, current_frame, length, is_seek)
+            if not cap.grab():
+                break
+            position += 1
+            if sample_ms is not None:
+                timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
+                if timestamp < current_ms:
+                    continue
+                current_ms = (timestamp // sample_ms + 1) * sample_ms
 
-        if ret and i == current_frame and len(frames) < N:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = cv2.resize(frame, img_size)
-
-            frames.append(frame)
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
             current_frame += frames_freq
-    cap.release()
+            # the sampler sees every frame and keeps the ones that show new wall
+            if sampler is not None and not sampler.update(frame):
+                continue
+            if frame_index is not None:
+                frame_index.append(position - 1)
+            yield frame if img_size is None else prepare_frame(frame, img_size)
+            sampled += 1
+    finally:
+        cap.release()
+        duration = time.perf_counter() - start_time
+        print(f"Sampled {sampled} frames in {duration:.2f} s, {sampled / max(duration, 1e-9):.1f} fps")
 
-    return frames
 
-
-def get_slice(frame, thickness=4):
-    slice = frame.copy()
-    slice.resize((thickness, frame.shape[0] * 2 + frame.shape[1] * 2, 3))
+@functools.lru_cache(maxsize=16)
+def get_slice_index(shape, thickness=4):
+    height, width = shape[0], shape[1]
+    length = 2 * height + 2 * width
+    rows = np.arange(thickness)[:, None]
     # up - left
-    xc = 0
-    for x in range(frame.shape[1] // 2, -1, -1):
-        xc += 1
-        yc = 0
-        for y in range(thickness):
-            slice[yc, xc] = frame[y, x]
-            yc += 1
+    up_left = (np.broadcast_to(rows, (thickness, width // 2 + 1)),
+               np.broadcast_to(np.arange(width // 2, -1, -1), (thickness, width // 2 + 1)))
     # left
-    for y in range(frame.shape[0]):
-        xc += 1
-        yc = 0
-        for x in range(thickness):
-            slice[yc, xc] = frame[y, x]
-            yc += 1
-    # bottom
-    for x in range(frame.shape[1]):
-        xc += 1
-        yc = 3
-        for y in range(frame.shape[0] - 1, frame.shape[0] - thickness - 1, -1):
-            slice[yc, xc] = frame[y, x]
-            yc -= 1
+    left = (np.broadcast_to(np.arange(height), (thickness, height)),
+            np.broadcast_to(rows, (thickness, height)))
+    # bottom, rows are stored flipped starting from the fourth one
+    bottom = (np.broadcast_to(height - 1 - (min(3, thickness - 1) - rows) % thickness, (thickness, width)),
+              np.broadcast_to(np.arange(width), (thickness, width)))
     # right
-    for y in range(frame.shape[0] - 1, -1, -1):
-        xc += 1
-        yc = 0
-        for x in range(frame.shape[1] - 1, frame.shape[1] - thickness - 1, -1):
-            slice[yc, xc] = frame[y, x]
-            yc += 1
-    # up - right
-    for x in range(frame.shape[1] - 1, frame.shape[1] // 2, -1):
-        xc += 1
-        if xc >= slice.shape[1]:
-            break
-        yc = 0
-        for y in range(thickness):
-            slice[yc, xc] = frame[y, x]
-            yc += 1
-    return slice
-
-
-def get_map(video_path, thickness=4, frame_freq=2):
-    frames = read_video(video_path, cf.IMG_SIZE, frames_freq=frame_freq)
-    sizes = (thickness, frames[0].shape[0] * 2 + frames[0].shape[1] * 2, 3)
-    img = frames[0].copy()
-    img.resize((sizes[0] * len(frames), sizes[1], sizes[2]))
-    for i in range(len(frames)):
-        slice = get_slice(frames[i], thickness)
-        for x in range(sizes[1]):
-            for y in range(sizes[0]):
-                img[y + i * thickness, x] = slice[y, x]
+    right = (np.broadcast_to(np.arange(height - 1, -1, -1), (thickness, height)),
+             np.broadcast_to(width - 1 - rows, (thickness, height)))
+    # up - right, the last column does not fit into the slice
+    up_right = (np.broadcast_to(rows, (thickness, width - width // 2 - 2)),
+                np.broadcast_to(np.arange(width - 1, width // 2 + 1, -1), (thickness, width - width // 2 - 2)))
+
+    index = np.empty((thickness, length), dtype=np.intp)
+    index[:, 1:] = np.concatenate([y * width + x for y, x in (up_left, left, bottom, right, up_right)], axis=1)
+    # the first column keeps whatever ndarray.resize left there: the leading pixels of the frame
+    index[:, 0] = np.arange(thickness) * length
+    blank = index[:, 0] >= height * width
+    index[blank, 0] = 0
+    index.setflags(write=False)
+    return index, (np.flatnonzero(blank) if blank.any() else None)
+
+
+def get_slices(frames, thickness=4):
+    index, blank = get_slice_index(frames.shape[1:3], thickness)
+    flat = frames.reshape(frames.shape[0], -1, frames.shape[3])
+    slices = np.take(flat, index, axis=1)
+    if blank is not None:
+        slices[:, blank, 0] = 0
+    return slices
+
+
+def get_slice(frame, thickness=4):
+    return get_slices(frame[np.newaxis], thickness)[0]
+
+
+@functools.lru_cache(maxsize=16)
+def get_slice_coords(shape, thickness=4):
+    index, blank = get_slice_index(shape, thickness)
+    # pixel centres of the slice relative to the frame centre
+    x = (index % shape[1]).astype(np.float32) - (shape[1] - 1) / 2
+    y = (index // shape[1]).astype(np.float32) - (shape[0] - 1) / 2
+    x.setflags(write=False)
+    y.setflags(write=False)
+    return x, y, blank
+
+
+def to_source_coords(x, y, shape):
+    # from the centred pixels of the IMG_SIZE frame to the pixels of the source frame, as cv2.resize maps them
+    scale_x, scale_y = shape[1] / cf.IMG_SIZE[0], shape[0] / cf.IMG_SIZE[1]
+    return (x + cf.IMG_SIZE[0] / 2) * scale_x - 0.5, (y + cf.IMG_SIZE[1] / 2) * scale_y - 0.5
+
+
+@functools.lru_cache(maxsize=16)
+def get_source_maps(shape, thickness=4):
+    x, y, blank = get_slice_coords((cf.IMG_SIZE[1], cf.IMG_SIZE[0]), thickness)
+    # fixed point maps are faster to remap with
+    return cv2.convertMaps(*to_source_coords(x, y, shape), cv2.CV_16SC2), blank
+
+
+def get_source_slice(frame, thickness=4):
+    # the slice of the resized RGB frame, read from the decoded one: only the band is resampled and converted
+    if frame.shape[1] == cf.IMG_SIZE[0] and frame.shape[0] == cf.IMG_SIZE[1]:
+        return cv2.cvtColor(get_slice(frame, thickness), cv2.COLOR_BGR2RGB)
+    (map_1, map_2), blank = get_source_maps(frame.shape[:2], thickness)
+    img = cv2.cvtColor(cv2.remap(frame, map_1, map_2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE),
+                       cv2.COLOR_BGR2RGB)
+    if blank is not None:
+        img[blank, 0] = 0
+    return img
+
+
+def get_stable_slice(frame, shift, thickness=4):
+    # only the band under the slice is moved back by the camera jitter, not the whole frame
+    dx, dy, angle = map(float, shift)
+    x, y, blank = get_slice_coords((cf.IMG_SIZE[1], cf.IMG_SIZE[0]), thickness)
+    cos, sin = m.cos(m.radians(angle)), m.sin(m.radians(angle))
+    map_x, map_y = to_source_coords(cos * x - sin * y + dx, sin * x + cos * y + dy, frame.shape[:2])
+    img = cv2.cvtColor(cv2.remap(frame, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE),
+                       cv2.COLOR_BGR2RGB)
+    if blank is not None:
+        img[blank, 0] = 0
+    return img
+
+
+# set in the chunk processes, the parent raises it to stop them between two frames
+chunk_cancel = None
+
+
+def set_chunk_cancel(event):
+    global chunk_cancel
+    chunk_cancel = event
+
+
+def get_map_chunk(video_path, start, stop, thickness=4, frame_freq=2):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video {video_path}")
+
+    # the seek may land a few frames off, so the chunk is read with a margin and aligned later by timestamps
+    margin = cf.CHUNK_SEEK_MARGIN
+    position = max(start - margin, 0)
+    if position > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+    timestamps, offsets, slices = [], [], []
+    try:
+        while stop is None or position < stop + margin:
+            if chunk_cancel is not None and chunk_cancel.is_set():
+                break
+            if not cap.grab():
+                break
+            timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+            distance = (position - 1) % frame_freq
+            if min(distance, frame_freq - distance) <= margin:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                offsets.append(len(timestamps) - 1)
+                slices.append(get_source_slice(frame, thickness))
+            position += 1
+    finally:
+        cap.release()
+    return np.array(timestamps), offsets, slices
+
+
+def get_chunk_bounds(length, workers):
+    chunks = min(length // cf.CHUNK_MIN_FRAMES, workers * cf.CHUNKS_PER_WORKER)
+    if chunks < 2:
+        return []
+    return [length * i // chunks for i in range(chunks)]
+
+
+def align_chunk(prev_timestamps, timestamps):
+    for start in np.flatnonzero(prev_timestamps == timestamps[0]):
+        overlap = min(len(prev_timestamps) - start, len(timestamps))
+        if np.array_equal(prev_timestamps[start:start + overlap], timestamps[:overlap]):
+            return start
+    return None
+
+
+def get_map_parallel(video_path, thickness=4, frame_freq=2, workers=2, progress=None, cancel=None, frame_index=None):
+    length = get_video_props(video_path)[0]
+    bounds = get_chunk_bounds(length, workers)
+    if len(bounds) == 0:
+        return None
+    stops = bounds[1:] + [None]
+    total = get_sampled_count(length, frame_freq)
+
+    slices = []
+    base = 0
+    prev_timestamps = None
+    # the map may be read from a thread of the window or of the pipeline, forking a process with running threads
+    # can leave locks of opencv held for good in the children, so they are started anew
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=set_chunk_cancel,
+                                   initargs=(stop_event,))
+    try:
+        futures = [executor.submit(get_map_chunk, video_path, start, stop, thickness, frame_freq)
+                   for start, stop in zip(bounds, stops)]
+        for start, stop, future in zip(bounds, stops, futures):
+            # a chunk may take thousands of frames, so the cancel is looked at while it is decoded
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                try:
+                    timestamps, offsets, chunk_slices = future.result(timeout=cf.CHUNK_POLL_INTERVAL)
+                    break
+                except TimeoutError:
+                    pass
+            if len(timestamps) == 0:
+                break
+            if prev_timestamps is not None:
+                shift = align_chunk(prev_timestamps, timestamps)
+                if shift is None:
+                    return None
+                base += shift
+            if stop is not None and base + len(timestamps) < stop:
+                return None
+            chunk_start = len(slices)
+            for offset, chunk_slice in zip(offsets, chunk_slices):
+                index = base + offset
+                if index >= 1 and (index - 1) % frame_freq == 0 and start <= index and (stop is None or index < stop):
+                    slices.append(chunk_slice)
+                    if frame_index is not None:
+                        frame_index.append(index)
+            prev_timestamps = timestamps
+            if progress is not None and len(slices) > chunk_start:
+                progress(np.concatenate(slices[chunk_start:]), len(slices), max(total, len(slices)))
+    finally:
+        # chunks still decoding stop at the next frame and release their captures, the rest never start
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+    if len(slices) == 0:
+        return np.empty((0, cf.IMG_SIZE[0] * 2 + cf.IMG_SIZE[1] * 2, 3), dtype=np.uint8)
+    return np.concatenate(slices)
+
+
+def get_map(video_path, thickness=4, frame_freq=2, sample_ms=None, workers=1, progress=None, cancel=None,
+            is_stabilization=False, is_adaptive=False, frame_index=None, threads=cf.PIPELINE_THREADS,
+            queue_depth=cf.PIPELINE_DEPTH, record=None):
+    # frame_index gets the source frame of every strip, the rows i * thickness and on come from frame_index[i],
+    # record gets the costs of the camera and probe tracking and of the pipeline stages, for the run stats
+    if frame_index is None:
+        frame_index = []
+    # the camera path and the probe travel are followed frame by frame, so such maps are read in one pass,
+    # as are maps built on disk, chunks come back whole from the processes
+    if workers > 1 and sample_ms is None and not is_stabilization and not is_adaptive and \
+            not scratch_store.is_enabled:
+        chunk_index = []
+        img = get_map_parallel(video_path, thickness, frame_freq, workers, progress, cancel, chunk_index)
+        if img is not None:
+            frame_index.extend(chunk_index)
+            return img
+    sizes = (thickness, cf.IMG_SIZE[0] * 2 + cf.IMG_SIZE[1] * 2, 3)
+    length, fps = get_video_props(video_path)
+    sampler = None
+    if is_adaptive:
+        # every frame is looked at, how many are kept is only known at the end
+        sampler = MotionSampler(thickness)
+        frame_freq, sample_ms = 1, None
+        count = get_sampled_count(length, cf.ADAPTIVE_MIN_FREQUENCY)
+    else:
+        count = get_sampled_count(length, frame_freq, sample_ms, fps)
+    img = scratch_store.empty((sizes[0] * count, sizes[1], sizes[2]), np.uint8, 'map')
+    rows = 0
+    reported = 0
+    report_time = time.perf_counter()
+    stabilizer = Stabilizer() if is_stabilization else None
+    frames = read_video(video_path, None, frames_freq=frame_freq, sample_ms=sample_ms, sampler=sampler,
+                        frame_index=frame_index)
+    slice_func = functools.partial(get_source_slice if stabilizer is None else get_stable_slice, thickness=thickness)
+    prepare_func = None if stabilizer is None else stabilizer.update
+    pipeline_stats = PipelineStats(threads)
+    if threads > 0:
+        strips = run_pipeline(frames, slice_func, prepare_func, threads, queue_depth, pipeline_stats)
+    else:
+        strips = get_strips(frames, slice_func, prepare_func)
+    # the capture is released as soon as the loop stops, cancelled or not
+    with contextlib.closing(strips):
+        for strip in strips:
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            if rows + thickness > img.shape[0]:
+                # the container reported less frames than it has
+                img = scratch_store.grow(img, max(2 * img.shape[0], rows + thickness), 'map')
+            img[rows:rows + thickness] = strip
+            rows += thickness
+            if progress is not None and rows - reported >= cf.PROGRESS_MIN_FRAMES * thickness and \
+                    time.perf_counter() - report_time >= cf.PROGRESS_INTERVAL:
+                # a copy, as the map may be reallocated while the rows wait to be drawn
+                total = count
+                if sampler is not None:
+                    # the strips to come are guessed from the share of the video already looked at
+                    total = round(rows // thickness * length / max(sampler.frames, 1))
+                progress(img[reported:rows].copy(), rows // thickness, max(total, rows // thickness))
+                reported = rows
+                report_time = time.perf_counter()
+    if record is not None:
+        if stabilizer is not None:
+            record['stabilization'] = stabilizer.get_record()
+        if sampler is not None:
+            record['motion'] = sampler.get_record()
+        if threads > 0:
+            record['pipeline'] = pipeline_stats.get_record()
+    if progress is not None and rows > reported:
+        progress(img[reported:rows].copy(), rows // thickness, rows // thickness)
+    if rows < img.shape[0]:
+        img = img[:rows] if isinstance(img, np.memmap) else scratch_store.grow(img, rows)
     return img
 
 
-def rotate_map(origin_map):
-    # img = origin_map.copy()
-    # return img
-    return origin_map
+def get_stored_map(video_path, thickness=4, frame_freq=2, sample_ms=None, workers=1, progress=None, cancel=None,
+                   is_stabilization=False, is_adaptive=False, frame_index=None, threads=cf.PIPELINE_THREADS,
+                   queue_depth=cf.PIPELINE_DEPTH, record=None):
+    key = map_store.get_key(video_path, thickness, frame_freq, sample_ms, is_stabilization, is_adaptive)
+    img = map_store.load(key)
+    if img is not None:
+        print("Map loaded from store", key)
+        if frame_index is not None:
+            frame_index.extend(map_store.load_frames(key).tolist())
+        return img
+    frames = []
+    img = get_map(video_path, thickness, frame_freq, sample_ms, workers, progress, cancel, is_stabilization,
+                  is_adaptive, frames, threads, queue_depth, record)
+    if frame_index is not None:
+        frame_index.extend(frames)
+    return map_store.save(key, img, dict(video=os.path.abspath(video_path), thickness=thickness,
+                                         frame_freq=frame_freq, sample_ms=sample_ms,
+                                         is_stabilization=is_stabilization, is_adaptive=is_adaptive),
+                          np.array(frames, dtype=np.int64))
+
+
+def get_preview_map(video_path, thickness=4, frame_freq=2, sample_ms=None, skew_effect=0, is_adaptive=False,
+                    cancel=None):
+    # one row from a small copy of every few hundredth frame, read by timestamps to seek over the rest
+    length, fps = get_video_props(video_path)
+    if length < 2:
+        return None
+    size = (round(cf.IMG_SIZE[0] * cf.PREVIEW_SCALE), round(cf.IMG_SIZE[1] * cf.PREVIEW_SCALE))
+    if fps > 0:
+        frames = read_video(video_path, size, sample_ms=max(length * 1000 / fps / cf.PREVIEW_STRIPS, 1))
+    else:
+        frames = read_video(video_path, size, frames_freq=max(length // cf.PREVIEW_STRIPS, 1))
+    strips = []
+    with contextlib.closing(frames):
+        for frame in frames:
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            strips.append(get_slice(frame, 1))
+    if len(strips) == 0:
+        return None
+    # the size of the full map, the preview is drawn stretched over it so both share the coordinates
+    if is_adaptive:
+        count = get_sampled_count(length, cf.ADAPTIVE_MIN_FREQUENCY)
+    else:
+        count = get_sampled_count(length, frame_freq, sample_ms, fps)
+    rows = max(count, 1) * thickness
+    img = skew_map(np.concatenate(strips), round(skew_effect * len(strips) / rows))
+    return img, (cf.IMG_SIZE[0] * 2 + cf.IMG_SIZE[1] * 2, rows + 2 * skew_effect)
+
+
+def rotate_map(origin_map, thickness=4):
+    # the seam is kept at one column, the offsets give the column every row was rolled by
+    offsets = get_row_offsets(origin_map, thickness)
+    if not offsets.any():
+        return origin_map, offsets
+    return roll_rows(origin_map, offsets), offsets
+
+
+@functools.lru_cache(maxsize=16)
+def get_skew_table(width, effect=20):
+    coef = 8 * m.pi / width
+    new_y = [int((m.cos(coef * x) + 1) * effect) for x in range(width)]
+    # columns with the same shift are joined into runs, each one is moved by a single block copy
+    runs = []
+    x_start = 0
+    for x in range(1, width + 1):
+        if x == width or new_y[x] != new_y[x_start]:
+            runs.append((new_y[x_start], x_start, x))
+            x_start = x
+    return tuple(runs)
 
 
 def skew_map(origin_img, effect=20):
-    img = origin_img.copy()
-    coef = 8 * m.pi / origin_img.shape[1]
-    img.resize((origin_img.shape[0] + 2 * effect, origin_img.shape[1], origin_img.shape[2]))
-    new_y = [0] * origin_img.shape[1]
-    for x in range(origin_img.shape[1]):
-        new_y[x] = int((m.cos(coef * x) + 1) * effect)
-    for y in range(origin_img.shape[0]):
-        for x in range(origin_img.shape[1]):
-            img[new_y[x] + y, x] = origin_img[y, x]
+    height = origin_img.shape[0]
+    if scratch_store.is_enabled:
+        # on disk the map is skewed by blocks of rows, each one made of the rows at most 2 * effect above it
+        img = scratch_store.empty((height + 2 * effect,) + origin_img.shape[1:], origin_img.dtype, 'skew')
+        for start, stop in scratch_store.get_blocks(len(img)):
+            origin_start = max(0, start - 2 * effect)
+            img[start:stop] = skew_rows(origin_img[origin_start:stop], origin_start, start, stop, effect, height)
+        return img
+    img = np.zeros((height + 2 * effect,) + origin_img.shape[1:], dtype=origin_img.dtype)
+    for shift, x_start, x_stop in get_skew_table(origin_img.shape[1], effect):
+        # rows above a shifted column keep the beginning of the map
+        img[:min(shift, height), x_start:x_stop] = origin_img[:min(shift, height), x_start:x_stop]
+        img[shift:shift + height, x_start:x_stop] = origin_img[:, x_start:x_stop]
     return img
 
 
-def crop_img(origin_img, x_=160, y_=70):
-    img = origin_img.copy()
-    img.resize((origin_img.shape[0] - 2*y_, origin_img.shape[1] - 2*x_,3))
-    for x in range(img.shape[1]):
-        for y in range(img.shape[0]):
-            img[y, x] = origin_img[y + y_, x + x_]
+def skew_rows(origin_rows, origin_start, start, stop, effect=20, height=None):
+    # rows start:stop of skew_map, origin_rows are the map rows from origin_start on
+    img = np.zeros((stop - start,) + origin_rows.shape[1:], dtype=origin_rows.dtype)
+    for shift, x_start, x_stop in get_skew_table(origin_rows.shape[1], effect):
+        # rows above the shift keep the beginning of the map, the rest are moved down by it
+        for y_start, y_stop, src_shift in ((start, min(stop, shift), 0), (max(start, shift), stop, shift)):
+            if height is not None:
+                y_stop = min(y_stop, height + src_shift)
+            if y_stop > y_start:
+                src_start = y_start - src_shift - origin_start
+                img[y_start - start:y_stop - start, x_start:x_stop] = \
+                    origin_rows[src_start:src_start + y_stop - y_start, x_start:x_stop]
     return img
 
 
+class DustStream:
+    # dust of the skewed map, searched while the map rows are still being read
+    def __init__(self, effect, dust_thresh_, dust_min_area_):
+        self.effect = effect
+        self.dust_thresh = dust_thresh_
+        self.dust_min_area = dust_min_area_
+        self.reset()
+
+    def reset(self) -> None:
+        self.detector = None
+        self.tail = None
+        self.height = 0
+        self.is_broken = False
+
+    def add_rows(self, rows_, stop_) -> None:
+        if stop_ - len(rows_) != self.height:
+            # the map is built again from the start, or rows were missed
+            self.reset()
+            self.is_broken = stop_ != len(rows_)
+        if self.is_broken or len(rows_) == 0:
+            return
+        if self.detector is None:
+            roi, offset = get_dust_roi(rows_)
+            self.detector = DustDetector(self.dust_thresh, self.dust_min_area, offset)
+            self.tail = rows_[:0]
+        # a skewed row is made of map rows at most 2 * effect above it
+        buffer = np.concatenate((self.tail, rows_))
+        start = self.height - len(self.tail)
+        self.height = stop_
+        self.detector.add_rows(get_dust_roi(skew_rows(buffer, start, stop_ - len(rows_), stop_, self.effect))[0])
+        self.tail = buffer[max(0, len(buffer) - 2 * self.effect):]
+
+    def get_table(self, height_):
+        if self.is_broken or self.detector is None or height_ != self.height:
+            return None
+        skewed = skew_rows(self.tail, self.height - len(self.tail), self.height, self.height + 2 * self.effect,
+                           self.effect, self.height)
+        self.detector.add_rows(get_dust_roi(skewed)[0])
+        table = self.detector.get_table()
+        self.detector = None
+        self.is_broken = True
+        return table
+
+
+def crop_img(origin_img, x_=160, y_=70, is_copy_=False):
+    img = origin_img[y_:origin_img.shape[0] - y_, x_:origin_img.shape[1] - x_]
+    return scratch_store.copy(img, 'crop') if is_copy_ else img
+
+
 def get_counters_list(image, dust_thresh_, dust_min_area_):
-    img_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return detect_dust(image, dust_thresh_, dust_min_area_).get_contours()
 
-    ret, thresh = cv2.threshold(img_gray, dust_thresh_, 255, cv2.THRESH_BINARY)
-    contours, hierarchy = cv2.findContours(image=thresh, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_NONE)
 
-    filters = []
-    for i in contours:
-        area = np.abs(cv2.contourArea(i))
-        if area > dust_min_area_:
-            filters.append(i)
-    return filters
+def get_dust_contours(origin_img, dust_thresh_, dust_min_area_):
+    return detect_map_dust(origin_img, dust_thresh_, dust_min_area_).get_contours()
 
 
 def dust_selection(origin_img, dust_thresh_, dust_min_area_):
-    origin_img_copy = origin_img.copy()
-    image = origin_img[0:origin_img.shape[0],
-            origin_img.shape[1] * 970 // 2240: origin_img.shape[1] * 1570 // 2240]
-
-    filters = get_counters_list(image, dust_thresh_, dust_min_area_)
-    cv2.drawContours(image=origin_img_copy, contours=filters, contourIdx=-1, color=(0, 0, 255), thickness=1,
-                     lineType=cv2.LINE_AA, offset=(origin_img.shape[1] * 970 // 2240, 0))
+    origin_img_copy = scratch_store.copy(origin_img, 'dust')
+    cv2.drawContours(image=origin_img_copy, contours=get_dust_contours(origin_img, dust_thresh_, dust_min_area_),
+                     contourIdx=-1, color=(0, 0, 255), thickness=1, lineType=cv2.LINE_AA)
     return origin_img_copy
 
 
-def save_map(img, index) -> str:
-    plt.imshow(img)
-    save_path = cf.OUT_DATA_PATH + '/' + f'map {index}.png'
-    plt.savefig(save_path)
-    return save_path
+def save_map(img, name) -> tuple:
+    return export_map(img, get_map_path(name))
+
+
+def get_map_path(video_path) -> str:
+    return cf.OUT_DATA_PATH + '/' + f'map {pathlib.Path(video_path).stem}.png'
+
+
+def get_build_params(thickness, frame_freq, skew_effect, dust, sample_ms, is_stabilization, is_adaptive) -> dict:
+    # everything the exported map depends on besides the video itself
+    return {'thickness': thickness, 'frame_freq': frame_freq, 'sample_ms': sample_ms, 'skew': skew_effect,
+            'dust': None if dust is None else list(dust), 'is_stabilization': is_stabilization,
+            'is_adaptive': is_adaptive}
+
 
+def get_params_path(video_path) -> pathlib.Path:
+    return pathlib.Path(get_map_path(video_path)).with_suffix('.json')
 
-def video_main():
+
+def save_build_params(video_path, params) -> None:
+    with open(get_params_path(video_path), 'w', encoding='utf-8') as file:
+        json.dump(params, file, indent=2)
+
+
+def load_build_params(video_path):
+    try:
+        with open(get_params_path(video_path), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def process_video(video_path, thickness=4, frame_freq=2, skew_effect=20, dust=None, sample_ms=None, workers=1,
+                  is_stats=cf.STATS_ENABLED, profile_path=None, is_stabilization=False, is_adaptive=False,
+                  is_out_of_core=cf.OUT_OF_CORE, block_rows=cf.BLOCK_ROWS, threads=cf.PIPELINE_THREADS,
+                  queue_depth=cf.PIPELINE_DEPTH):
+    start_time = time.perf_counter()
+    scratch_store.set_enabled(is_out_of_core)
+    scratch_store.block_rows = block_rows
+    stats = RunStats(pathlib.Path(video_path).name, is_stats, profile_path)
+    if profile_path is not None:
+        # the profiler only sees this thread, the map is read without the pipeline threads then
+        threads = 0
+    try:
+        with stats.stage('map') as record:
+            img = get_stored_map(video_path, thickness, frame_freq, sample_ms, workers,
+                                 is_stabilization=is_stabilization, is_adaptive=is_adaptive, threads=threads,
+                                 queue_depth=queue_depth, record=record)
+            record['frames'] = img.shape[0] // max(thickness, 1)
+        with stats.stage('rotate') as record:
+            img, offsets = rotate_map(img, thickness)
+            record['rolled_rows'] = int(np.count_nonzero(offsets))
+        with stats.stage('skew'):
+            img = skew_map(img, skew_effect)
+        if dust is not None:
+            with stats.stage('dust'):
+                img = dust_selection(img, *dust)
+        with stats.stage('export'):
+            paths, export_time, nbytes = save_map(img, video_path)
+            save_build_params(video_path, get_build_params(thickness, frame_freq, skew_effect, dust, sample_ms,
+                                                           is_stabilization, is_adaptive))
+    except Exception as e:
+        return video_path, f'{type(e).__name__}: {e}', time.perf_counter() - start_time, stats.finish(error=str(e))
+    return video_path, f'{img.shape[0]} rows, {len(paths)} file(s), {nbytes / 2 ** 20:.1f} MiB ' \
+                       f'written in {export_time:.2f} s', time.perf_counter() - start_time, \
+        stats.finish(rows=img.shape[0], nbytes=nbytes)
+
+
+def parse_batch_args(argv):
+    parser = argparse.ArgumentParser(prog='main.py batch', description='Build maps for every video in a directory.')
+    parser.add_argument('--input', default=cf.INPUT_DATA_PATH, help='directory with *.mp4 videos')
+    parser.add_argument('--thickness', type=int, default=cf.DEFAULT_THICKNESS)
+    parser.add_argument('--frame-freq', type=int, default=cf.DEFAULT_FRAME_FREQUENCY)
+    parser.add_argument('--sample-ms', type=int, default=None, help='sample every N ms instead of every N frames')
+    parser.add_argument('--skew', type=int, default=cf.DEFAULT_SKEW_EFFECT)
+    parser.add_argument('--stabilize', action='store_true', help='compensate camera shake before slicing')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='take a strip whenever the probe moved by its thickness, instead of every N frames')
+    parser.add_argument('--dust', action='store_true', help='draw dust contours')
+    parser.add_argument('--dust-thresh', type=int, default=cf.DEFAULT_DUST_THRESH)
+    parser.add_argument('--dust-min-area', type=int, default=cf.DEFAULT_DUST_MIN_AREA)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--decode-workers', type=int, default=cf.DEFAULT_DECODE_WORKERS,
+                        help='processes decoding chunks of one video')
+    parser.add_argument('--pipeline-threads', type=int, default=cf.PIPELINE_THREADS,
+                        help='threads cutting strips while a single process decodes, 0 does it all in turn')
+    parser.add_argument('--pipeline-depth', type=int, default=cf.PIPELINE_DEPTH,
+                        help='frames decoded ahead of the strip threads')
+    parser.add_argument('--force', action='store_true', help='rebuild maps that are up to date')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help=f'keep the maps in {cf.SCRATCH_PATH}/ and process them by blocks of rows')
+    parser.add_argument('--block-rows', type=int, default=cf.BLOCK_ROWS, help='rows of a block with --out-of-core')
+    parser.add_argument('--no-stats', action='store_true', help=f'do not log stage timings to {cf.STATS_LOG_PATH}')
+    parser.add_argument('--profile', action='store_true', help=f'save a cProfile of every video to {cf.PROFILE_PATH}/')
+    return parser.parse_args(argv)
+
+
+def video_main(argv=None):
+    args = parse_batch_args(argv)
+    dust = (args.dust_thresh, args.dust_min_area) if args.dust else None
+    params = get_build_params(args.thickness, args.frame_freq, args.skew, dust, args.sample_ms, args.stabilize,
+                              args.adaptive)
     video_list = []
-    for video_path in pathlib.Path(cf.INPUT_DATA_PATH).glob('*.mp4'):
+    for video_path in sorted(pathlib.Path(args.input).glob('*.mp4')):
+        map_path = pathlib.Path(get_map_path(video_path))
+        if not map_path.exists():
+            map_path = get_chunk_path(map_path, 0)
+        # a map is only kept if it is newer than the video and was built with the same settings
+        if not args.force and map_path.exists() and map_path.stat().st_mtime >= video_path.stat().st_mtime and \
+                load_build_params(video_path) == params:
+            print(f'{video_path.name}: up to date')
+            continue
         video_list.append(str(video_path))
+    if len(video_list) == 0:
+        return
+
+    pathlib.Path(cf.OUT_DATA_PATH).mkdir(parents=True, exist_ok=True)
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(video_list)))) as executor:
+        futures = [executor.submit(process_video, video_path, args.thickness, args.frame_freq, args.skew, dust,
+                                   args.sample_ms, args.decode_workers, not args.no_stats,
+                                   get_profile_path(video_path) if args.profile else None, args.stabilize,
+                                   args.adaptive, args.out_of_core, args.block_rows, args.pipeline_threads,
+                                   args.pipeline_depth)
+                   for video_path in video_list]
+        results = []
+        for video_path, future in zip(video_list, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append((video_path, f'{type(e).__name__}: {e}', 0., None))
 
-    for video_index in range(len(video_list)):
-        img = get_map(video_list[9], frame_freq=1)
-        img = rotate_map(img)
-        img = skew_map(img)
-        save_map(img, video_index)
-        break
+    print()
+    print('Video'.ljust(39), 'Time, s', 'Result')
+    for video_path, status, duration, record in results:
+        print(pathlib.Path(video_path).name.ljust(39), f'{duration:7.2f}', status)
+        if record is not None:
+            write_record(record)
+            print(' ' * 47 + format_stages(record['stages'], record['seconds']))
+    print(f'Total: {len(results)} videos in {time.perf_counter() - start_time:.2f} s')
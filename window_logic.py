@@ -1,15 +1,12 @@
-import os, sys, pathlib
+import os
+import time
 
-import cv2
-import numpy as np
 from PySide6.QtWidgets import QApplication, QMainWindow, QPushButton, QFormLayout, QLayout, QMenuBar,\
-    QLineEdit, QLabel, QWidget, QDialog, QVBoxLayout, QHBoxLayout, QFileDialog, QSizePolicy, QCheckBox
-from PySide6.QtGui import QPainter, QPixmap, QIcon, QIntValidator, QScreen, QPen, QBrush, QColor, QImage
-from PySide6.QtCore import Qt, QPoint, QSize, QRect, QLine
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
-from video_logic import skew_map, save_map, get_map, crop_img, dust_selection, get_counters_list
-from loadlabel import loading
+    QLineEdit, QLabel, QWidget, QDialog, QVBoxLayout, QHBoxLayout, QFileDialog, QCheckBox
+from PySide6.QtGui import QPainter, QPixmap, QIcon, QIntValidator, QPen, QBrush, QColor, QImage
+from PySide6.QtCore import Qt, QPoint, QSize, QRect, QLine, QTimer
+from loadlabel import loading, JobScheduler, MessageBox
+from map_viewer import MapViewer
 import config as cf
 
 
@@ -42,23 +39,36 @@ class SettingsDialog(QDialog):
         self.thickness = cf.DEFAULT_THICKNESS
         self.frame_frequency = cf.DEFAULT_FRAME_FREQUENCY
         self.skew_effect = cf.DEFAULT_SKEW_EFFECT
+        self.sample_ms = cf.DEFAULT_SAMPLE_MS
+        self.decode_workers = cf.DEFAULT_DECODE_WORKERS
+        self.is_adaptive = False
 
         self.is_stabilization = False
 
         self.is_dust_selection = True
-        self.dust_min_area = 50
-        self.dust_thresh = 200
+        self.dust_min_area = cf.DEFAULT_DUST_MIN_AREA
+        self.dust_thresh = cf.DEFAULT_DUST_THRESH
 
         self.hole_amount = 10
+        self.is_quick_preview = cf.QUICK_PREVIEW
+
+        self.is_profile = False
+        self.is_out_of_core = cf.OUT_OF_CORE
 
         self.thickness_editor = QLineEdit(self)
         self.frame_frequency_editor = QLineEdit(self)
         self.skew_effect_editor = QLineEdit(self)
+        self.sample_ms_editor = QLineEdit(self)
+        self.decode_workers_editor = QLineEdit(self)
+        self.adaptive_editor = QCheckBox("Выборка по движению зонда", self)
         self.stabilization_editor = QCheckBox("Применить стабилизацию", self)
         self.dust_selection_editor = QCheckBox("Отображать контуры пыли", self)
         self.dust_min_editor = QLineEdit(self)
         self.dust_thresh_editor = QLineEdit(self)
         self.hole_amount_editor = QLineEdit(self)
+        self.quick_preview_editor = QCheckBox("Быстрый предпросмотр до построения карты", self)
+        self.profile_editor = QCheckBox("Профилировать построение карты", self)
+        self.out_of_core_editor = QCheckBox("Хранить карты на диске (длинные записи)", self)
         self._editors_init()
 
         self.ok_btn = QPushButton("Oк", self)
@@ -82,6 +92,19 @@ class SettingsDialog(QDialog):
         self.skew_effect_editor.setText(str(self.skew_effect))
         self.skew_effect_editor.textChanged.connect(self.skew_effect_edit_action)
 
+        self.sample_ms_editor.setAlignment(Qt.AlignLeft)
+        self.sample_ms_editor.setValidator(QIntValidator())
+        self.sample_ms_editor.setText(str(self.sample_ms))
+        self.sample_ms_editor.textChanged.connect(self.sample_ms_edit_action)
+
+        self.decode_workers_editor.setAlignment(Qt.AlignLeft)
+        self.decode_workers_editor.setValidator(QIntValidator())
+        self.decode_workers_editor.setText(str(self.decode_workers))
+        self.decode_workers_editor.textChanged.connect(self.decode_workers_edit_action)
+
+        self.adaptive_editor.setChecked(self.is_adaptive)
+        self.adaptive_editor.stateChanged.connect(self.adaptive_edit_action)
+
         self.stabilization_editor.setChecked(self.is_stabilization)
         self.stabilization_editor.stateChanged.connect(self.stabilization_edit_action)
 
@@ -103,12 +126,24 @@ class SettingsDialog(QDialog):
         self.hole_amount_editor.setText(str(self.hole_amount))
         self.hole_amount_editor.textChanged.connect(self.hole_amount_edit_action)
 
+        self.quick_preview_editor.setChecked(self.is_quick_preview)
+        self.quick_preview_editor.stateChanged.connect(self.quick_preview_edit_action)
+
+        self.profile_editor.setChecked(self.is_profile)
+        self.profile_editor.stateChanged.connect(self.profile_edit_action)
+
+        self.out_of_core_editor.setChecked(self.is_out_of_core)
+        self.out_of_core_editor.stateChanged.connect(self.out_of_core_edit_action)
+
     def _widgets_to_layout(self) -> None:
         layout = QFormLayout()
         layout.addRow("Параметры вырезки", None)
         layout.addRow("Толщина вырезки: ", self.thickness_editor)
         layout.addRow("Частота кадров: ", self.frame_frequency_editor)
         layout.addRow("Эффект искажения: ", self.skew_effect_editor)
+        layout.addRow("Интервал выборки, мс (0 - по частоте): ", self.sample_ms_editor)
+        layout.addRow("Процессов декодирования: ", self.decode_workers_editor)
+        layout.addWidget(self.adaptive_editor)
         layout.addRow("Параметры стабилизации", None)
         layout.addWidget(self.stabilization_editor)
         layout.addRow("Параметры выискивания", None)
@@ -117,6 +152,10 @@ class SettingsDialog(QDialog):
         layout.addRow("Яркость выискиваемой пыли", self.dust_thresh_editor)
         layout.addRow("Параметры отображения", None)
         layout.addRow("Количество отверстий", self.hole_amount_editor)
+        layout.addWidget(self.quick_preview_editor)
+        layout.addRow("Диагностика", None)
+        layout.addWidget(self.profile_editor)
+        layout.addWidget(self.out_of_core_editor)
         layout.addWidget(self.ok_btn)
         self.setLayout(layout)
 
@@ -138,8 +177,23 @@ class SettingsDialog(QDialog):
             self.skew_effect = 50
         self.skew_effect_editor.setText(str(self.skew_effect))
 
+    def sample_ms_edit_action(self, text_: str) -> None:
+        self.sample_ms = 0 if len(text_) <= 0 or text_.find('-') != -1 else int(text_)
+        if self.sample_ms > 10000:
+            self.sample_ms = 10000
+        self.sample_ms_editor.setText(str(self.sample_ms))
+
+    def decode_workers_edit_action(self, text_: str) -> None:
+        self.decode_workers = 1 if len(text_) <= 0 or text_.find('-') != -1 or int(text_) < 1 else int(text_)
+        if self.decode_workers > os.cpu_count():
+            self.decode_workers = os.cpu_count()
+        self.decode_workers_editor.setText(str(self.decode_workers))
+
+    def adaptive_edit_action(self, state_):
+        self.is_adaptive = bool(state_)
+
     def stabilization_edit_action(self, state_):
-        self.is_stabilization = state_
+        self.is_stabilization = bool(state_)
 
     def dust_selection_edit_action(self, state_):
         self.is_dust_selection = state_
@@ -162,6 +216,21 @@ class SettingsDialog(QDialog):
             self.hole_amount = 18
         self.hole_amount_editor.setText(str(self.hole_amount))
 
+    def quick_preview_edit_action(self, state_):
+        self.is_quick_preview = bool(state_)
+
+    def profile_edit_action(self, state_):
+        self.is_profile = bool(state_)
+
+    def out_of_core_edit_action(self, state_):
+        self.is_out_of_core = bool(state_)
+
+    def get_map_params(self) -> tuple:
+        return self.thickness, self.frame_frequency, self.sample_ms, self.is_stabilization, self.is_adaptive
+
+    def get_view_params(self) -> tuple:
+        return self.skew_effect, self.dust_thresh, self.dust_min_area
+
     def run(self) -> None:
         self.exec()
 
@@ -213,6 +282,8 @@ class PaintTube(QWidget):
         super().__init__(parent_)
         self.setMinimumSize(2000, 1000)
         self.img = None
+        self.img_array = None
+        self.contour_mask = None
         self.image_frame = QLabel(self)
         self.hole_amount = 10
 
@@ -226,17 +297,28 @@ class PaintTube(QWidget):
         painter.draw_all()
 
     def connect_img(self, img_, coord_list_) -> None:
-        self.img = img_.copy()
-        self.img.resize((self.img.shape[0], self.img.shape[1], 4))
-        for x in range(self.img.shape[1]):
-            for y in range(self.img.shape[0]):
-                self.img[y, x] = [250, 250, 250, 255]
-        for i in range(len(coord_list_)):
-            for p in coord_list_[i]:
-                col = img_[p[0][1], p[0][0]]
-                self.img[p[0][1], p[0][0]] = [col[0], col[1], col[2], 0]
-        self.img = QImage(self.img.data, self.img.shape[1], self.img.shape[0],
-                          QImage.Format_RGB888).rgbSwapped()
+        import cv2
+        from scratch_store import scratch_store
+
+        height, width = img_.shape[:2]
+        blocks = scratch_store.get_blocks(height)
+        if self.img_array is None or self.img_array.shape[:2] != (height, width):
+            self.img_array = scratch_store.empty((height, width, 4), name_='tube')
+            for start, stop in blocks:
+                self.img_array[start:stop] = cf.TUBE_BACKGROUND_COLOR
+            self.contour_mask = scratch_store.zeros((height, width), name_='tube_mask')
+        else:
+            # only the pixels of the previous contours differ from the background
+            for start, stop in blocks:
+                self.img_array[start:stop][self.contour_mask[start:stop] != 0] = cf.TUBE_BACKGROUND_COLOR
+                self.contour_mask[start:stop] = 0
+        cv2.drawContours(self.contour_mask, coord_list_, -1, 255, 1)
+        for start, stop in blocks:
+            is_contour = self.contour_mask[start:stop] != 0
+            self.img_array[start:stop][is_contour, :3] = img_[start:stop][is_contour]
+            self.img_array[start:stop][is_contour, 3] = 0
+        # the image shares the array memory
+        self.img = QImage(self.img_array.data, width, height, self.img_array.strides[0], QImage.Format_RGBA8888)
         # self.image_frame.setPixmap(QPixmap.fromImage(self.img))
         # self.image_frame.setWindowOpacity(0.1)
 
@@ -244,34 +326,104 @@ class PaintTube(QWidget):
         self.setVisible(is_active_)
 
 
-class MplCanvas(FigureCanvasQTAgg):
-    def __init__(self):
-        self.fig = Figure()
-        self.ax = self.fig.add_subplot(111)
-        FigureCanvasQTAgg.__init__(self, self.fig)
-        FigureCanvasQTAgg.setSizePolicy(self, QSizePolicy.Expanding, QSizePolicy.Expanding)
-        FigureCanvasQTAgg.updateGeometry(self)
-
-
 class MatGraphWidget(QWidget):
     def __init__(self, parent: QWidget = None):
         QWidget.__init__(self, parent)
         self.is_set_img = False
-        self.canvas = MplCanvas()
+        self.viewer = MapViewer(self)
+        self.progress_label = QLabel(self)
+        self.progress_label.setVisible(False)
+        # rows of the map being built, kept in one buffer growing twice at a time
+        self.preview = None
+        self.preview_rows = 0
+        self.preview_done = 0
+        self.preview_first = (0., 0)
+        self.is_preview_drawn = False
+        self.is_redraw_planned = False
+        # a quick preview stays on screen until the map it stands for is ready
+        self.is_quick_preview = False
         self.vbl = QVBoxLayout()
-        self.vbl.addWidget(self.canvas)
+        self.vbl.addWidget(self.progress_label)
+        self.vbl.addWidget(self.viewer)
         self.setLayout(self.vbl)
+        self.resize(cf.DEFAULT_MAP_SIZE)
 
-    def set_img(self, img):
+    def set_img(self, img, contours_=None):
+        is_keep_view = self.preview is not None or self.is_quick_preview
+        self.is_quick_preview = False
         self.is_set_img = True
-        self.canvas.ax.imshow(img)
-        # self.canvas.ax.legend()
-        self.canvas.draw()
+        self.preview = None
+        self.preview_rows = 0
+        self.preview_done = 0
+        self.progress_label.setVisible(False)
+        self.viewer.set_img(img, is_keep_view)
+        self.viewer.set_overlay([] if contours_ is None else contours_)
+
+    def set_preview(self, img_, size_) -> None:
+        # drawn over the size of the full map, the zoom and position are kept when that one replaces it
+        self.is_quick_preview = True
+        self.viewer.set_img(img_, False, size_)
+        self.viewer.set_overlay([])
+        self.progress_label.setText("Предпросмотр, карта строится")
+        self.progress_label.setVisible(True)
+        self.setVisible(True)
+
+    def reset_progress(self) -> None:
+        # the map being built will not come, neither its rows nor its quick preview stay on screen
+        self.is_quick_preview = False
+        self.preview = None
+        self.preview_rows = 0
+        self.preview_done = 0
+        self.progress_label.setVisible(False)
+
+    def set_overlay_visible(self, is_visible_: bool) -> None:
+        self.viewer.set_overlay_visible(is_visible_)
+
+    def append_rows(self, rows_, done_: int, total_: int) -> None:
+        from scratch_store import scratch_store
+
+        if self.preview is None or done_ < self.preview_done:
+            # rows of a new map, or the same map being built again from the start
+            self.preview = None
+            self.preview_rows = 0
+            self.is_preview_drawn = False
+            self.preview_first = (time.perf_counter(), done_)
+        rows = self.preview_rows + len(rows_)
+        if self.preview is None or rows > len(self.preview):
+            # a new buffer, the viewer may still show the old one
+            preview = scratch_store.empty((max(rows, 2 * self.preview_rows),) + rows_.shape[1:], rows_.dtype,
+                                          'preview')
+            if self.preview is not None:
+                preview[:self.preview_rows] = self.preview[:self.preview_rows]
+            self.preview = preview
+        self.preview[self.preview_rows:rows] = rows_
+        self.preview_rows = rows
+        self.preview_done = done_
+        text = f"Построение карты: {100 * done_ // max(total_, 1)}%"
+        # the rate is known from the second report on, the clock starts at the first one
+        if done_ > self.preview_first[1]:
+            elapsed = time.perf_counter() - self.preview_first[0]
+            eta = elapsed * (total_ - done_) / (done_ - self.preview_first[1])
+            text += f", осталось примерно {eta:.0f} с"
+        self.progress_label.setText(text)
+        self.progress_label.setVisible(True)
+        self.setVisible(True)
+        # rows arriving faster than the viewer redraws are drawn together, over a quick preview only at the end
+        if not self.is_redraw_planned and not self.is_quick_preview:
+            self.is_redraw_planned = True
+            QTimer.singleShot(cf.PREVIEW_REDRAW_INTERVAL, self._draw_preview)
+
+    def _draw_preview(self) -> None:
+        self.is_redraw_planned = False
+        if self.preview is None or self.preview_rows == 0 or self.is_quick_preview:
+            return
+        self.viewer.set_img(self.preview[:self.preview_rows], self.is_preview_drawn)
+        self.is_preview_drawn = True
+        self.viewer.set_overlay([])
 
     def clear(self):
         self.is_set_img = False
-        self.canvas.ax.clear()
-        self.canvas.axes_init()
+        self.viewer.clear()
 
 
 def select_path_to_files(filter_str_: str, parent_: QWidget = None, **kwargs) -> list:
@@ -305,11 +457,18 @@ class MenuWidget(QWidget):
         self.map_widget = MatGraphWidget(self)
         self.map_widget.setVisible(False)
         self.img = None
+        self.dust = None
+        self.video_path = None
+        # every build of a map has an id, its quick preview is only drawn while that build is pending
+        self.build_count = 0
+        self.preview_builds = set()
+        self.preview_build = None
 
         self.menu_bar = QMenuBar(self)
         self.menu_bar.addAction("Выбрать видео").triggered.connect(self.select_video_action)
         self.menu_bar.addAction("Сохранить как").triggered.connect(self.save_action)
-        self.menu_bar.addAction("Настройки").triggered.connect(self.settings_dialog.run)
+        self.menu_bar.addAction("Настройки").triggered.connect(self.settings_action)
+        self.menu_bar.addAction("Отменить", "Esc").triggered.connect(self.cancel_action)
         self.menu_bar.addAction("&Выйти", "Shift+Esc").triggered.connect(self.exit_action)
 
     def _widgets_to_layout(self) -> None:
@@ -319,40 +478,191 @@ class MenuWidget(QWidget):
         layout.addWidget(self.paint_map)
         self.setLayout(layout)
 
-    def _save_by_path(self, path_: str, type_: str) -> None:
-        if self.map_widget is not None and self.map_widget.is_set_img:
-            QScreen.grabWindow(self.main_window.app.primaryScreen(),
-                               self.map_widget.winId()).save(path_, type_)
-
     def save_action(self) -> None:
-        filename = QFileDialog.getSaveFileName(self, filter="PNG files (*.png) ;; JPG files (*.jpg; *.jpeg)")
-        self._save_by_path(filename[0], filename[0].split('.')[-1].lower())
+        if self.img is None:
+            return
+        path = QFileDialog.getSaveFileName(self, filter="PNG files (*.png) ;; JPG files (*.jpg; *.jpeg)")[0]
+        if len(path) == 0:
+            return
+        if path.split('.')[-1].lower() not in ('png', 'jpg', 'jpeg'):
+            path += '.png'
+        self.save_map(self.img, self.dust if self.settings_dialog.is_dust_selection else None, path)
+
+    @loading('show_saved', True)
+    def save_map(self, img_, dust_, path_: str, progress_=None, cancel_=None):
+        from export_logic import export_map
+        from scratch_store import scratch_store
+        import cv2
+
+        if dust_ is not None:
+            img_ = scratch_store.copy(img_, 'export')
+            cv2.drawContours(img_, dust_.get_contours(), -1, cf.VIEWER_OVERLAY_COLOR, 1, cv2.LINE_AA)
+        return export_map(img_, path_)
+
+    def show_saved(self, result_) -> None:
+        paths, export_time, nbytes = result_
+        message = f"Сохранено файлов: {len(paths)}, {nbytes / 2 ** 20:.1f} МиБ за {export_time:.2f} с\n" + \
+                  "\n".join(str(path) for path in paths)
+        MessageBox().information("Сохранение карты", message)
 
     def select_video_action(self) -> None:
-        path = select_path_to_one_file('MP4 files (*.mp4)', self)
-        self.compute_video(path)
-
-    @loading('show_results')
-    def compute_video(self, path) -> None:
-        self.img = get_map(path, self.settings_dialog.thickness, self.settings_dialog.frame_frequency)
-        self.img = skew_map(self.img, self.settings_dialog.skew_effect)
-        self.paint_map.connect_img(self.img, get_counters_list(self.img, self.settings_dialog.dust_thresh,
-                                   self.settings_dialog.dust_min_area))
-
-        if self.settings_dialog.is_dust_selection:
-            self.img = dust_selection(self.img, self.settings_dialog.dust_thresh,
-                                      self.settings_dialog.dust_min_area)
-        self.show_results()
-
-    def show_results(self):
+        for path in select_path_to_files('MP4 files (*.mp4)', self):
+            self.video_path = path
+            self.build_video(path)
+
+    def settings_action(self) -> None:
+        params = self.settings_dialog.get_map_params() + self.settings_dialog.get_view_params()
+        self.settings_dialog.run()
+        # dust contours are an overlay of the viewer, showing them needs no new map
+        self.map_widget.set_overlay_visible(self.settings_dialog.is_dust_selection)
+        if self.video_path is not None and \
+                params != self.settings_dialog.get_map_params() + self.settings_dialog.get_view_params():
+            self.build_video(self.video_path)
+
+    def cancel_action(self) -> None:
+        JobScheduler().cancel_all()
+
+    def build_video(self, path) -> None:
+        # jobs run in order, the preview is on screen before the full map is started
+        self.build_count += 1
+        if self.settings_dialog.is_quick_preview:
+            self.preview_builds.add(self.build_count)
+            self.compute_preview(path, self.build_count)
+        job = self.compute_video(path, self.build_count)
+        job.cancelled.connect(self.stop_build)
+        job.exception_signal.connect(self.stop_build)
+
+    @loading('show_preview', True)
+    def compute_preview(self, path, build=0, progress_=None, cancel_=None):
+        from video_logic import get_preview_map
+        from map_store import map_store
+        from stage_cache import stage_cache, get_video_key
+
+        settings = self.settings_dialog
+        # a map built before comes at once, it needs no preview
+        if stage_cache.contains(('map', get_video_key(path)) + settings.get_map_params()) or \
+                map_store.contains(map_store.get_key(path, settings.thickness, settings.frame_frequency,
+                                                     settings.sample_ms or None, settings.is_stabilization,
+                                                     settings.is_adaptive)):
+            return build, None
+        return build, get_preview_map(path, settings.thickness, settings.frame_frequency, settings.sample_ms or None,
+                                     settings.skew_effect, settings.is_adaptive, cancel_)
+
+    def show_preview(self, result_) -> None:
+        build, preview = result_
+        # the full map may already be shown, or its build cancelled
+        if preview is None or build not in self.preview_builds:
+            return
+        self.preview_build = build
+        self.map_widget.set_preview(*preview)
+        self.paint_map.set_active(False)
+
+    def stop_build(self, job_, *args) -> None:
+        # the build job of a map was cancelled or failed, what was shown of it goes away for the last map
+        build = job_.args[2]
+        self.preview_builds.discard(build)
+        if build == self.preview_build:
+            self.preview_build = None
+        self.map_widget.reset_progress()
+        if self.img is not None:
+            self.show_results()
+        else:
+            self.map_widget.clear()
+
+    @loading('show_results', True, progress_func_='show_progress')
+    def compute_video(self, path, build=0, progress_=None, cancel_=None):
+        from concurrent.futures import CancelledError
+        from video_logic import skew_map, get_stored_map, get_counters_list, DustStream
+        from dust_logic import detect_map_dust
+        from stage_cache import stage_cache, get_video_key
+        from run_stats import RunStats, get_profile_path
+        from scratch_store import scratch_store
+
+        settings = self.settings_dialog
+        scratch_store.set_enabled(settings.is_out_of_core)
+        stats = RunStats(os.path.basename(path), profile_path_=get_profile_path(path) if settings.is_profile else None)
+        dust_stream = DustStream(settings.skew_effect, settings.dust_thresh, settings.dust_min_area)
+
+        def report_progress(rows_, done_: int, total_: int) -> None:
+            # dust is searched in the map rows as they are read, not after the whole map
+            dust_stream.add_rows(rows_, done_ * settings.thickness)
+            if progress_ is not None:
+                progress_(rows_, done_, total_)
+
+        def cached_stage(stage_: str, key_: tuple, func_, *args):
+            with stats.stage(stage_) as record:
+                hits = stage_cache.hits
+                value = stage_cache.get(key_, func_, *args)
+                record['is_cached'] = stage_cache.hits > hits
+            return value
+
+        try:
+            map_key = ('map', get_video_key(path)) + settings.get_map_params()
+            with stats.stage('map') as record:
+                hits = stage_cache.hits
+                origin_img = stage_cache.get(map_key, get_stored_map, path, settings.thickness,
+                                             settings.frame_frequency, settings.sample_ms or None,
+                                             settings.decode_workers, report_progress, cancel_,
+                                             settings.is_stabilization, settings.is_adaptive,
+                                             # the profiler only sees this thread, so no pipeline threads then
+                                             threads=0 if settings.is_profile else cf.PIPELINE_THREADS,
+                                             record=record)
+                record['is_cached'] = stage_cache.hits > hits
+                if not record['is_cached']:
+                    record['frames'] = origin_img.shape[0] // max(settings.thickness, 1)
+            skew_key = map_key + ('skew', settings.skew_effect)
+            img = cached_stage('skew', skew_key, skew_map, origin_img, settings.skew_effect)
+            if cancel_ is not None and cancel_.is_set():
+                raise CancelledError()
+            dust_key = skew_key + (settings.dust_thresh, settings.dust_min_area)
+            counters = cached_stage('contours', dust_key + ('counters',), get_counters_list, img,
+                                    settings.dust_thresh, settings.dust_min_area)
+            with stats.stage('overlay'):
+                self.paint_map.connect_img(img, counters)
+            with stats.stage('dust') as record:
+                dust = dust_stream.get_table(len(origin_img))
+                if dust is not None:
+                    stage_cache.put(dust_key + ('dust',), dust)
+                else:
+                    dust = stage_cache.get(dust_key + ('dust',), detect_map_dust, img, settings.dust_thresh,
+                                           settings.dust_min_area)
+                dust.get_contours()
+                record['defects'] = len(dust)
+        except BaseException:
+            stats.finish()
+            raise
+        stats.stop_profile()
+        print(stage_cache)
+        return build, img, dust, stats
+
+    def show_progress(self, rows_, done_: int, total_: int) -> None:
+        self.map_widget.append_rows(rows_, done_, total_)
+
+    def show_results(self, result_=None):
+        from run_stats import RunStats
+
+        stats = RunStats('render', False)
+        if result_ is not None:
+            build, self.img, self.dust, stats = result_
+            self.preview_builds.discard(build)
+            if build == self.preview_build:
+                self.preview_build = None
         if self.img is None:
             return
-        self.map_widget.set_img(self.img)
-        self.map_widget.setVisible(True)
-        self.paint_map.set_active(True)
-        self.paint_map.update()
+        with stats.stage('render'):
+            self.map_widget.set_img(self.img, self.dust.get_contours())
+            self.map_widget.set_overlay_visible(self.settings_dialog.is_dust_selection)
+            self.map_widget.setVisible(True)
+            self.map_widget.viewer.viewport().repaint()
+            self.paint_map.set_active(True)
+            self.paint_map.update()
+        if stats.finish(rows=self.img.shape[0]) is not None:
+            stats.log()
+            self.main_window.statusBar().showMessage(str(stats))
 
     def exit_action(self) -> None:
+        JobScheduler().cancel_all()
+        JobScheduler().pool.waitForDone()
         self.main_window.exit()
 
 